@@ -16,6 +16,11 @@
     3. original_seds/exp9_pf_6gyr_interpolated.cat
     4. original_seds/exp9_pf_12gyr_interpolated.cat
 
+:Batch mode:
+    interpolate_library interpolates every flux column of every catalog at
+    once and writes one original_seds/*_interpolated.npz per catalog, or the
+    legacy text files with fmt='text'.
+
  """
 
 
@@ -25,6 +30,106 @@ import numpy as np
 import scipy as sp
 import scipy.interpolate
 import time
+from sed_utils import load_sed, write_sed, SED
+
+# legacy output names for the flux columns of ssp_pf.cat and exp9_pf.cat
+ages = {6: '6gyr', 12: '12gyr'}
+
+
+def get_outfile(infile, col):
+    """Get text output name for a flux column.
+
+    e.g. column 6 of ssp_pf.cat is ssp_pf_6gyr_interpolated.cat and
+    column 3 is ssp_pf_col3_interpolated.cat
+    """
+    if col in ages:
+        return infile[:-4] + '_' + ages[col] + '_interpolated.cat'
+    return infile[:-4] + '_col{:d}_interpolated.cat'.format(col)
+
+
+def interpolate_columns(infile, lambda1, lambda2, usecols=None):
+    """Interpolate many flux columns of a sed catalog in one call.
+
+    :Usage: waverange, iflux, cols = interpolate_columns(infile, 1000, 12000)
+
+    Column 0 is wavelength. If usecols is None all the other columns are
+    interpolated. One cubic spline is set up for all the columns, iflux has
+    shape (len(waverange), len(cols)).
+    """
+    table = load_sed(infile, skiprows=15)[1]
+    if usecols is None:
+        usecols = range(1, table.shape[1])
+    cols = list(usecols)
+    wave = table[:, 0]
+    flux = table[:, cols]
+
+    # wavelength range to interpolate
+    nums = int(lambda2 - lambda1) + 1
+    waverange = np.linspace(lambda1, lambda2, num=nums, endpoint=True)
+
+    # interpolation of all columns along wavelength axis
+    iflux = sp.interpolate.interp1d(wave, flux, kind='cubic', axis=0)(waverange)
+
+    return waverange, iflux, cols
+
+
+def write_text_columns(infile, waverange, iflux, cols):
+    """Write each interpolated column to its own legacy text file."""
+    outfiles = []
+    for k, col in enumerate(cols):
+        outfile = get_outfile(infile, col)
+        write_sed(outfile, waverange, iflux[:, k], fmt=('%-13.1f','%.13e'))
+        outfiles.append(outfile)
+    return outfiles
+
+
+def write_binary_columns(infile, waverange, iflux, cols):
+    """Write all interpolated columns to one columnar npz file.
+
+    The file has arrays wave, flux (one column per input column) and cols.
+    """
+    outfile = infile[:-4] + '_interpolated.npz'
+    np.savez(outfile, wave=waverange, flux=iflux, cols=np.array(cols))
+    return [outfile]
+
+
+def interpolate_seds(infile, lambda1, lambda2, usecols=None):
+    """Interpolate flux columns of a catalog and return SED objects.
+
+    :Usage: sed6, sed12 = interpolate_seds(infile, 1000, 12000, (6, 12))
+
+    Nothing is written, each SED is named by its legacy output file.
+    """
+    waverange, iflux, cols = interpolate_columns(infile, lambda1, lambda2,
+                                                 usecols)
+    return [SED(waverange, iflux[:, k], name=get_outfile(infile, col))
+            for k, col in enumerate(cols)]
+
+
+def interpolate_library(infiles, lambda1, lambda2, usecols=None, fmt='npz'):
+    """Interpolate every flux column of every input catalog.
+
+    :Usage: interpolate_library(['original_seds/ssp_pf.cat'], 1000, 12000)
+
+    :Outputs:
+        fmt = 'npz'  : infile_interpolated.npz for each infile
+
+        fmt = 'text' : one legacy text file per column, see get_outfile
+    """
+    outfiles = []
+    for infile in infiles:
+        waverange, iflux, cols = interpolate_columns(infile, lambda1, lambda2,
+                                                     usecols)
+        if fmt == 'npz':
+            outfiles += write_binary_columns(infile, waverange, iflux, cols)
+        elif fmt == 'text':
+            outfiles += write_text_columns(infile, waverange, iflux, cols)
+        else:
+            raise ValueError('Unknown output format: %s' % fmt)
+        print('Interpolated %d columns from file: %s' % (len(cols), infile))
+
+    return outfiles
+
 
 def interpolate_flux(infile, lambda1,lambda2):
     """ Interpolate the sed file in step of 1 Angstrom. 
@@ -37,30 +142,9 @@ def interpolate_flux(infile, lambda1,lambda2):
        e.g. ssp_pf.cat will be ssp_pf_6gyr_interpolated.cat
        
     """
-    wave, flux6, flux12 = np.loadtxt(infile, skiprows=15, unpack=True,
-                                   dtype='float', usecols=(0, 6, 12))
-    #print('{} {} {}'.format('wave[0] = ', wave[0], ''))
-    #print('{} {} {}'.format('flux[0] = ', flux[0], '\n'))
-
-    # wavelength range to interpolate
-    nums = int(lambda2 - lambda1) + 1
-    waverange = np.linspace(lambda1, lambda2, num=nums, endpoint=True)
-    #print('{} {} {}'.format('waverange :\n', waverange, ''))
-
-
-    # interpolation
-    #print('{} {} {}'.format('\nInterpolating flux from the file : ', infile, ' \n...'))
-    iflux6  = sp.interpolate.interp1d(wave, flux6, kind='cubic')(waverange)
-    iflux12 = sp.interpolate.interp1d(wave, flux12, kind='cubic')(waverange)
-
-
-    # write to a file
-    outfile6  = infile[:-4] + '_6gyr_interpolated.cat'
-    outfile12 = infile[:-4] + '_12gyr_interpolated.cat'
-    np.savetxt(outfile6, list(map(list, zip(*[waverange, iflux6]))),
-               fmt=['%-13.1f','%.13e'], delimiter='\t', newline='\n')
-    np.savetxt(outfile12, list(map(list, zip(*[waverange, iflux12]))),
-               fmt=['%-13.1f','%.13e'], delimiter='\t', newline='\n')
+    waverange, iflux, cols = interpolate_columns(infile, lambda1, lambda2,
+                                                 usecols=(6, 12))
+    outfile6, outfile12 = write_text_columns(infile, waverange, iflux, cols)
 
 
     # output info
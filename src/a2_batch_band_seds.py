@@ -0,0 +1,139 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Jul 27, 2017 Thu
+# Last update :
+"""This program creates band sets for many seds and band schemes in parallel.
+
+:Depends:
+    a2_create_narrowband_seds.py
+
+:Inputs:
+    original_seds/*_interpolated.cat
+
+:Outputs:
+    band_sets/sed_name/scheme_name/narrowband*.sed
+
+    band_sets/sed_name/scheme_name/broadband.sed
+
+:Info:
+
+  1. A band scheme is a dictionary with a name and the keyword arguments
+     of get_band_edges, e.g.
+
+     {'name': 'width50', 'nbands': 50, 'method': 'equal_width'}
+
+     Use get_filter_schemes for the same bands in all lsst filters.
+     It may also have 'compact': True to write compact seds and
+     'compress': True to write gzip compressed seds.
+
+  2. Every sed x scheme combination is one task, the tasks are run on a
+     process pool and each task writes to its own output folder.
+
+  3. The time taken by each task is printed at the end.
+
+"""
+
+# Imports
+import concurrent.futures
+import contextlib
+import glob
+import os
+import time
+import a2_create_narrowband_seds as a2
+from filter_utils import filters
+
+# Global Variables
+outroot = 'band_sets'
+schemes = [{'name': 'width{:d}'.format(n), 'nbands': n, 'method': 'equal_width'}
+           for n in (7, 21, 50, 100)]
+
+
+def get_filter_schemes(nbands=21, method='equal_width', names=filters,
+                       threshold=0.05):
+    """Get one band scheme per lsst filter, e.g. to run u to y in one batch.
+
+    The passband of each filter is derived from its phosim filter file.
+    """
+    return [{'name': '{}_{}{:d}'.format(name, method, nbands),
+             'nbands': nbands, 'method': method,
+             'filterfile': name, 'threshold': threshold}
+            for name in names]
+
+
+def get_tasks(infiles, schemes, outroot):
+    """Get one task for every sed and band scheme."""
+    tasks = []
+    for infile in infiles:
+        sedname = os.path.splitext(os.path.basename(infile))[0]
+        for scheme in schemes:
+            outdir = os.path.join(outroot, sedname, scheme['name'])
+            tasks.append((infile, scheme, outdir))
+    return tasks
+
+
+def make_band_set(task):
+    """Create one band set, run inside a worker process.
+
+    :Returns: (outdir, number of seds written, seconds taken)
+    """
+    begin_time = time.time()
+    infile, scheme, outdir = task
+    options = ('name', 'compact', 'compress')
+    kwargs = {k: v for k, v in scheme.items() if k not in options}
+
+    # the a2 functions print a lot, keep the worker output quiet
+    with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+        breakpoints = a2.get_band_edges(**kwargs)
+        a2.replace_outdir(outdir)
+        outfiles = a2.write_band_seds(infile, outdir, breakpoints,
+                                      compact=scheme.get('compact', False),
+                                      compress=scheme.get('compress', False))
+
+    return outdir, len(outfiles), time.time() - begin_time
+
+
+def run_band_sets(infiles, schemes, outroot=outroot, nprocs=None):
+    """Create band sets for all seds and schemes on a process pool.
+
+    :Usage: run_band_sets(['original_seds/exp9_pf_6gyr_interpolated.cat'], schemes)
+
+    nprocs is the number of worker processes, default is number of cores.
+    """
+    tasks = get_tasks(infiles, schemes, outroot)
+    print('{} {} {}'.format('\nNumber of band sets : ', len(tasks), ''))
+
+    results = []
+    with concurrent.futures.ProcessPoolExecutor(max_workers=nprocs) as pool:
+        futures = [pool.submit(make_band_set, task) for task in tasks]
+        for future in concurrent.futures.as_completed(futures):
+            outdir, nfiles, seconds = future.result()
+            print('{:8.3f} sec  {:4d} seds  {}'.format(seconds, nfiles, outdir))
+            results.append((outdir, nfiles, seconds))
+
+    return results
+
+
+def main():
+    infiles = sorted(glob.glob('original_seds/*_interpolated.cat'))
+    run_band_sets(infiles, schemes, outroot)
+
+
+if __name__ == '__main__':
+
+    # beginning time
+    begin_time,begin_ctime = time.time(), time.ctime()
+
+    # run main program
+    main()
+
+    # print the time taken
+    end_time,end_ctime  = time.time(), time.ctime()
+    seconds             = end_time - begin_time
+    m, s                = divmod(seconds, 60)
+    h, m                = divmod(m, 60)
+    d, h                = divmod(h, 24)
+    print('\nBegin time: ', begin_ctime,'\nEnd   time: ', end_ctime,'\n' )
+    print("Time taken: {0:.0f} days, {1:.0f} hours, \
+          {2:.0f} minutes, {3:f} seconds.".format(d, h, m, s))
@@ -6,6 +6,10 @@
 
 """This program creates 21 narrowbands and one broadband seds.
 
+The number of bands and the band edges can be changed from the command line,
+e.g. ``python a2_create_narrowband_seds.py -n 50 -m equal_throughput -f
+~/phosim/data/lsst/filter_2.txt``.
+
 :Inputs:
     original_seds/exp9_pf_12gyr_interpolated.cat
 
@@ -15,7 +19,7 @@
     narrowband_seds/narrowband*.sed
     
 :Runtime: 
-    15 sec
+    1 sec
 
 :Info:
 
@@ -72,11 +76,14 @@ import numpy as np
 import os
 import shutil
 import time
+from sed_utils import load_sed, write_text, SED
+from filter_utils import read_filter, get_filter_file, get_passband
 
 # Global Variables
 infile = r'original_seds/exp9_pf_6gyr_interpolated.cat'
 lookup = '5000.0'
 outfolder = 'narrowband_seds'
+data_cache = {}
 
 def replace_outdir(outdir):
     """Replace a folder."""   
@@ -104,16 +111,21 @@ def replace_line(infile, line_num, text):
 
 
 def get_data(infile):
-    """Get data."""
-    data = ''
-    with open(infile, 'r') as f:
-        data = f.readlines()
+    """Get data.
+
+    The lines are read once per process and reused until the file changes.
+    """
+    stat = os.stat(infile)
+    key = (stat.st_size, stat.st_mtime_ns)
+    if infile not in data_cache or data_cache[infile][0] != key:
+        with open(infile, 'r') as f:
+            data_cache[infile] = (key, f.readlines())
+    data = data_cache[infile][1]
     #print('data[0] = \n', data[0])
     return data
 
 def get_ncom_lines(data):
     """Get number of comment lines. """
-    data = get_data(infile)
     ncom_lines = 0
     for line in data:
         if line.strip().startswith('#'):
@@ -124,6 +136,28 @@ def get_ncom_lines(data):
     return ncom_lines
 
 
+def get_wave_index(wave, values):
+    """Get exact row index of each wavelength value.
+
+    :Usage: get_wave_index(wave, [5310, 5388]) gives [4310, 4388]
+
+    wave must be sorted. The rows are found by binary search, so the
+    cost does not grow with the number of lines times number of values,
+    and 5310.0 never matches 15310.0 as a substring search would.
+    """
+    values = np.asarray(values, dtype='float')
+    if np.any(np.diff(wave) <= 0):
+        raise ValueError('Wavelengths of the sed are not sorted')
+
+    idx = np.searchsorted(wave, values)
+    found = idx < len(wave)
+    found[found] = wave[idx[found]] == values[found]
+    if not np.all(found):
+        raise ValueError('Wavelengths not on the sed grid: %s'
+                         % values[~found])
+    return [int(i) for i in idx]
+
+
 def get_normalizing_line(infile, lookup,data):
     """Get normalizing line of 500 nm for phosim.
     
@@ -135,17 +169,11 @@ def get_normalizing_line(infile, lookup,data):
       after: 5000.0 5.297875e-07
     
     """
-    data = get_data(infile)
-    normalize_line = ''
-    normalize_line_num = 0
     ncom_lines = get_ncom_lines(data)
-    with open(infile) as f:
-        for num, line in enumerate(f, 1):
-            if lookup in line:
-                normalize_line = line
-                normalize_line_num = num - 1
-                #print ('normalize line = ', line)
-                #print ('normalize line num = ', num)
+    wave = load_sed(infile)[1][:, 0]
+    normalize_line_num = ncom_lines + get_wave_index(wave, [float(lookup)])[0]
+    normalize_line = data[normalize_line_num]
+    #print ('normalize line = ', normalize_line)
 
     print('{} {} {}'.format('normalize_line            : ', normalize_line, ''))
     print('{} {} {}'.format('normalize_line_num        : ', normalize_line_num, ''))
@@ -172,7 +200,7 @@ def get_normalizing_line(infile, lookup,data):
     
 
 
-def get_breakpoints():
+def get_breakpoints(lambda_start=5310.0, lambda_end=6960.0, nbands=21):
     """Get breakpoints.
 
 From red band filter of lsst : phosim/data/lsst/filter_2.txt
@@ -183,14 +211,14 @@ We take wavelength range such that transmission <= 5%, and we get 531 nm - 696 n
   
   5310, 5388, 5467, 5545, 5624, 5703, 5781, 5860, 5938, 6017, 6096, 6174, 6253, 6331, 6410, 6489, 6567, 6646, 6724, 6803, 6882, 6960
 
+.. note::
 
+   The step is rounded to one decimal, so the last band absorbs the
+   remainder of the range, e.g. 6882-6960 for 21 bands.
 
 """
-    lambda_start = 5310.0
-    lambda_end = 6960.0
-
     # step between sed0 and sed1
-    step = (lambda_end - lambda_start) / 21.0  # 7.9 nm
+    step = (lambda_end - lambda_start) / float(nbands)  # 7.9 nm
 
 
     # sed file has decimal precision 1, so round off step to one precision
@@ -200,30 +228,100 @@ We take wavelength range such that transmission <= 5%, and we get 531 nm - 696 n
     #print('{} {} {}'.format('lambda range = ', lambda_end - lambda_start, 'nm'))
     #print('{} {} {}'.format('step = ', step, ' nm\n'))
 
-    breakpoints = np.arange(lambda_start, lambda_end, step)
+    breakpoints = lambda_start + step * np.arange(nbands)
     breakpoints = np.append(breakpoints, lambda_end)
     breakpoints = [int(i) for i in breakpoints]
+    check_breakpoints(breakpoints)
 
-    print(' ','     '.join(map(str, range(22))))
+    print(' ','     '.join(map(str, range(len(breakpoints)))))
     print('{} {}{}'.format('breakpoints = \n', breakpoints, '\n\n'))
     #print('{} {}{}'.format('\nlen breakpoints = ', len(breakpoints), ''))
     
     return breakpoints
 
 
+def check_breakpoints(breakpoints):
+    """Make sure breakpoints are integers in strictly increasing order."""
+    if len(breakpoints) < 2:
+        raise ValueError('Need at least two breakpoints, got %s' % breakpoints)
+    for lower, upper in zip(breakpoints[:-1], breakpoints[1:]):
+        if upper <= lower:
+            raise ValueError('Breakpoints must be strictly increasing: %s'
+                             % breakpoints)
+
+
+def get_throughput_breakpoints(filterfile, lambda_start, lambda_end, nbands):
+    """Get breakpoints so that each band has equal filter throughput.
+
+    The transmission is integrated over the passband and the cumulative
+    throughput is split in nbands equal parts. Breakpoints are rounded to
+    the 1 Angstrom grid of the sed.
+    """
+    wave, trans = read_filter(get_filter_file(filterfile))
+    grid = np.arange(lambda_start, lambda_end + 1, dtype='float')
+    tgrid = np.interp(grid, wave, trans)
+
+    # cumulative trapezoid integral of transmission over the passband
+    cum = np.concatenate(([0.0], np.cumsum(0.5 * (tgrid[1:] + tgrid[:-1]))))
+    targets = np.linspace(0.0, cum[-1], nbands + 1)
+    breakpoints = np.interp(targets, cum, grid)
+    breakpoints = [int(round(i)) for i in breakpoints]
+    check_breakpoints(breakpoints)
+
+    print('{} {}{}'.format('breakpoints = \n', breakpoints, '\n\n'))
+    return breakpoints
+
+
+def get_band_edges(nbands=21, method='equal_width', filterfile=None,
+                   threshold=0.05, edges=None,
+                   lambda_start=5310.0, lambda_end=6960.0):
+    """Get band edges for any number of bands.
+
+    :Usage:
+      get_band_edges(50, 'equal_width', 'phosim/data/lsst/filter_2.txt')
+
+    :Methods:
+      equal_width      : equal steps, same as get_breakpoints.
+
+      equal_throughput : equal integrated filter transmission per band.
+
+      user             : edges given by the user, in Angstrom.
+
+    If filterfile is given the passband is read from it using threshold,
+    otherwise lambda_start and lambda_end are used. filterfile may be a
+    phosim filter file or an lsst filter name (u, g, r, i, z, y), see
+    filter_utils.
+    """
+    if method == 'user':
+        if edges is None:
+            raise ValueError('method user needs edges')
+        breakpoints = [int(i) for i in edges]
+        check_breakpoints(breakpoints)
+        return breakpoints
+
+    if filterfile is not None:
+        lambda_start, lambda_end = get_passband(filterfile, threshold)
+
+    if method == 'equal_width':
+        return get_breakpoints(lambda_start, lambda_end, nbands)
+    elif method == 'equal_throughput':
+        if filterfile is None:
+            raise ValueError('method equal_throughput needs a filterfile')
+        return get_throughput_breakpoints(filterfile, lambda_start,
+                                          lambda_end, nbands)
+    else:
+        raise ValueError('Unknown band edge method: %s' % method)
+
+
 def get_lin_nums():
     """Get index of breakpoints."""
-    lin_nums = []
     breakpoints = get_breakpoints()
-    with open(infile, 'r') as fi:
-        data = fi.readlines()
-        idx, tmpidx = 0, 0
-        for line in data:
-            idx += 1
-            for value in list(breakpoints):
-                if (str(value) + '.0') in line:
-                    tmpidx = idx
-                    lin_nums.append(tmpidx)
+    data = get_data(infile)
+    ncom_lines = get_ncom_lines(data)
+    wave = load_sed(infile)[1][:, 0]
+
+    # line numbers start from 1
+    lin_nums = [ncom_lines + i + 1 for i in get_wave_index(wave, breakpoints)]
     print('{} {} {}'.format('\nlin_nums = \n', lin_nums, ''))
     print('{} {} {}'.format('\nlen lin_nums = \n', len(lin_nums), '\n'))
     
@@ -290,107 +388,251 @@ narrowband20.sed
 
     
     """
-    lin_nums = get_lin_nums()
-    data = get_data(infile)
-    ncom_lines = get_ncom_lines(data)
-    normalize_line, normalize_line_num = get_normalizing_line(infile, lookup,data)
+    breakpoints = get_breakpoints()
     replace_outdir(outfolder)
-    
-    print('{} {} {}'.format('\nwriting 21 output files ...', '', '\n'))
-    nfiles = 21
-    i = 0
-
-    for i in range(nfiles):
-        outfile = outfolder + r'/' + 'narrowband{:d}.sed'.format(i)
-        with open(outfile, 'a') as f:
-
-            # print
-            print('{} {} {}'.format('writing to the file ', outfile, '...'))
-
-            # add equal chunk_size data to all files
-            lower = lin_nums[i] - 1
-            upper = lin_nums[i + 1] - 1
-
-            # write comment lines
-            f.write(''.join(data[:ncom_lines]))
-
-            for line in data:
-                if not line.startswith('#'):
-                    row = line.split()
-                    tmp = str(row[0]) +'        ' +'0.0\n'
-                    f.write(''.join(tmp))
-
-                # print('{} {}{}'.format('\ni = ', i,'' ))
-            j = 0
-            for j in range(lin_nums[i], lin_nums[i + 1], 1):
-                # print('{} {}{}'.format('j= ', j,'' ))
-                replace_line(outfile, j - 1, data[j - 1])
-                # print('{} {}{}'.format('data[j] = ', data[j],'' ))
-
-        # add extra lines from index21 to index22 to last file
-        # -1 is for 695.0
-        if i == 20:
-            for j in range(lin_nums[20] - 1, lin_nums[21], 1):
-                replace_line(outfile, j, data[j])
-        # rewrite normalized line at 500 nm from input sed to all output files
-        replace_line(outfile, normalize_line_num, normalize_line)
+    write_band_seds(infile, outfolder, breakpoints, broadband=False)
 
 
 def write_broadband_sed(outfolder):
     """Write broadband sed."""
-    data = get_data(infile)
-    ncom_lines = get_ncom_lines(data)
-    lin_nums = get_lin_nums()
-    normalize_line, normalize_line_num = get_normalizing_line(infile, lookup,data)
-    
-    
-    outfile = outfolder + r'/' + 'broadband.sed'
-    print('{} {} {}'.format('writing to the file ', outfile, '...'))
-    with open(outfile, 'a') as f:
+    breakpoints = get_breakpoints()
+    write_band_seds(infile, outfolder, breakpoints, narrowbands=False)
 
-        # write comments
-        f.write(''.join(data[:ncom_lines]))
+    # output info
+    print('{} {} {}'.format('\ninput sed            : ', infile, ''))
+    print('{} {} {}'.format('output folder        : ', outfolder, ''))
+    print('{} {} {}'.format('output broadband sed :', outfolder + r'/' + 'broadband.sed', ''))
 
-        # change column two to zeros
-        for line in data:
-            if not line.startswith('#'):
-                row = line.split()
-                tmp = str(row[0]) + '        ' + '0.0\n'
-                f.write(''.join(tmp))
 
-        # replace line between lambda_start and lambda_end
-        for j in range(lin_nums[0], lin_nums[21], 1):
-            replace_line(outfile, j - 1, data[j - 1])
+def load_sed_lines(infile):
+    """Load the sed file once into numpy arrays.
 
-        # add one more line
-        replace_line(outfile, j, data[j])
+    infile is a sed file name or a sed_utils.SED object, e.g. from a0.
 
+    :Returns:
+        header : comment lines joined as one string.
 
-    # rewrite normalized line at 500 nm from input sed to all output files
-    replace_line(outfile, normalize_line_num, normalize_line)
+        wave   : float array of wavelengths of the data lines.
 
-    # output info
-    print('{} {} {}'.format('\ninput sed            : ', infile, ''))
-    print('{} {} {}'.format('output folder        : ', outfolder, ''))
-    print('{} {} {}'.format('output broadband sed :', outfile, ''))
+        flux   : float array of flux of the data lines.
 
-def main(): 
-    data = get_data(infile)
-    ncom_lines = get_ncom_lines(data)
-    normalize_line, normalize_line_num = get_normalizing_line(infile, lookup,data)
-    breakpoints = get_breakpoints()
-    lin_nums = get_lin_nums()
+        lines  : object array of the data lines, left stripped.
+
+        zeros  : object array of the same lines with flux set to 0.0
+
+    .. note::
+
+       Row k of the arrays is line ncom_lines + k of the input file.
+    """
+    if isinstance(infile, SED):
+        header = ''.join(infile.header)
+        body = infile.to_lines()
+        wave, flux = infile.wave, infile.flux
+    else:
+        data = get_data(infile)
+        ncom_lines = get_ncom_lines(data)
+        header = ''.join(data[:ncom_lines])
+        body = [line for line in data[ncom_lines:] if not line.startswith('#')]
+        table = load_sed(infile)[1]
+        wave, flux = np.array(table[:, 0]), np.array(table[:, 1])
+
+    tokens = [line.split()[0] for line in body]
+    lines = np.array([line.lstrip() for line in body], dtype=object)
+    zeros = np.array([tok + '        ' + '0.0\n' for tok in tokens], dtype=object)
+
+    return header, wave, flux, lines, zeros
+
+
+def get_normalize_row(wave, lines):
+    """Get row index and new text of the normalizing line of 500 nm.
+
+    The flux of this row is decreased by a factor of 100, the same as
+    get_normalizing_line.
+    """
+    normalize_idx = get_wave_index(wave, [float(lookup)])[0]
+    normalize_line = lines[normalize_idx]
+    flux = normalize_line.split()[1]
+    fluxn = float(flux) / 100.0
+    normalize_line = normalize_line.replace(str(flux), str(fluxn))
+    print('{} {} {}'.format('normalize_line            : ', normalize_line, ''))
+    return normalize_idx, normalize_line
+
+
+def get_band_masks(wave, breakpoints):
+    """Get boolean masks of the wavelength grid for each band.
+
+    Band i is breakpoints[i] <= wave < breakpoints[i+1], the last band also
+    includes its upper breakpoint.
+    """
+    masks = []
+    nbands = len(breakpoints) - 1
+    for i in range(nbands):
+        lower, upper = breakpoints[i], breakpoints[i + 1]
+        if i == nbands - 1:
+            masks.append((wave >= lower) & (wave <= upper))
+        else:
+            masks.append((wave >= lower) & (wave < upper))
+    return masks
+
+
+def get_compact_mask(nonzero):
+    """Get rows to keep in a compact sed.
+
+    Keeps the nonzero rows, the zero row on each side of every nonzero run
+    and the first and last rows of the grid. Linear interpolation of the
+    kept rows then gives back exactly the full sed, including the zeros.
+    """
+    keep = nonzero.copy()
+    keep[1:] |= nonzero[:-1]
+    keep[:-1] |= nonzero[1:]
+    keep[0] = keep[-1] = True
+    return keep
+
+
+def build_band_sed(header, lines, zeros, mask, normalize_idx, normalize_line,
+                   compact=False):
+    """Build the text of one band sed from the in-band mask.
+
+    If compact is True only the rows from get_compact_mask are written.
+    """
+    out = np.where(mask, lines, zeros)
+    out[normalize_idx] = normalize_line.lstrip()
+    if compact:
+        nonzero = mask.copy()
+        nonzero[normalize_idx] = True
+        out = out[get_compact_mask(nonzero)]
+    return header + ''.join(out)
+
+
+def integrate_sed(wave, flux):
+    """Integrate flux over wavelength with the trapezoid rule."""
+    return np.sum(0.5 * (flux[1:] + flux[:-1]) * np.diff(wave))
+
+
+def verify_compact_sed(wave, flux, cwave, cflux, rtol=1e-12):
+    """Check that a compact sed gives the same spectrum as the full sed.
+
+    :Usage: ok = verify_compact_sed(wave, flux, cwave, cflux)
+
+    The compact sed is linearly interpolated back on the full grid and
+    must match every flux value, the wavelength range and the integral.
+    """
+    iflux = np.interp(wave, cwave, cflux)
+    total = integrate_sed(wave, flux)
+    ctotal = integrate_sed(cwave, cflux)
+
+    same_range = cwave[0] == wave[0] and cwave[-1] == wave[-1]
+    same_flux = np.array_equal(iflux, flux)
+    same_total = np.isclose(ctotal, total, rtol=rtol, atol=0.0)
+
+    print('{} {} {}'.format('rows full/compact    : ', len(wave), len(cwave)))
+    print('{} {} {}'.format('integral full/compact: ', total, ctotal))
+    return bool(same_range and same_flux and same_total)
+
+
+def verify_compact_files(fullfile, compactfile):
+    """Check a compact sed file against the full sed file."""
+    wave, flux = load_sed(fullfile, cache=False)[1][:, :2].T
+    cwave, cflux = load_sed(compactfile, cache=False)[1][:, :2].T
+    return verify_compact_sed(wave, flux, cwave, cflux)
+
+
+def write_band_seds(infile, outfolder, breakpoints, narrowbands=True,
+                    broadband=True, compact=False, verify=False,
+                    compress=False):
+    """Write narrowband and broadband seds in a single pass over the sed.
+
+    :Usage: write_band_seds(infile, outfolder, breakpoints)
+
+    infile is a sed file name or a sed_utils.SED object. The input sed is
+    read once, every band is built with a boolean mask over
+    the wavelength grid and each output file is written with one call.
+
+    With compact=True only the in-band rows, the 500 nm row and the zero
+    rows bracketing them are written. With verify=True each compact file
+    is read back and checked against the full band sed, and a ValueError
+    is raised if the spectrum differs. With compress=True the seds are
+    written as narrowband*.sed.gz, which phosim reads directly.
+
+    :Outputs:
+        outfolder/narrowband*.sed
+
+        outfolder/broadband.sed
+    """
+    header, wave, flux, lines, zeros = load_sed_lines(infile)
+    normalize_idx, normalize_line = get_normalize_row(wave, lines)
+    normalize_flux = float(normalize_line.split()[1])
+
+    bands = []
+    if narrowbands:
+        masks = get_band_masks(wave, breakpoints)
+        print('{} {} {}'.format('\nwriting', len(masks), 'output files ...\n'))
+        for i, mask in enumerate(masks):
+            bands.append(('narrowband{:d}.sed'.format(i), mask))
+    if broadband:
+        mask = (wave >= breakpoints[0]) & (wave <= breakpoints[-1])
+        bands.append(('broadband.sed', mask))
+
+    outfiles = []
+    for name, mask in bands:
+        outfile = outfolder + r'/' + name + ('.gz' if compress else '')
+        print('{} {} {}'.format('writing to the file ', outfile, '...'))
+        text = build_band_sed(header, lines, zeros, mask,
+                              normalize_idx, normalize_line, compact)
+        write_text(outfile, text, compress)
+        outfiles.append(outfile)
+
+        if compact and verify:
+            bflux = np.where(mask, flux, 0.0)
+            bflux[normalize_idx] = normalize_flux
+            cwave, cflux = load_sed(outfile, cache=False)[1][:, :2].T
+            if not verify_compact_sed(wave, bflux, cwave, cflux):
+                raise ValueError('Compact sed changes the spectrum: %s'
+                                 % outfile)
+
+    return outfiles
+
+
+def main(nbands=21, method='equal_width', filterfile=None, threshold=0.05,
+         edges=None, outfolder=outfolder, compact=False, verify=False,
+         compress=False):
+    breakpoints = get_band_edges(nbands, method, filterfile, threshold, edges)
+    replace_outdir(outfolder)
     #check_data()
-    write_narrowband_seds(outfolder)
-    write_broadband_sed(outfolder)
+    write_band_seds(infile, outfolder, breakpoints, compact=compact,
+                    verify=verify, compress=compress)
     
     
 ##==============================================================================
 ## Main program
 ##==============================================================================
 if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Create narrowband seds.')
+    parser.add_argument('-n', '--nbands', type=int, default=21)
+    parser.add_argument('-m', '--method', default='equal_width',
+                        choices=['equal_width', 'equal_throughput', 'user'])
+    parser.add_argument('-f', '--filterfile', default=None,
+                        help='phosim filter file, e.g. phosim/data/lsst/filter_2.txt, '
+                             'or lsst filter name u g r i z y')
+    parser.add_argument('-t', '--threshold', type=float, default=0.05)
+    parser.add_argument('-e', '--edges', type=int, nargs='+', default=None,
+                        help='band edges in Angstrom for method user')
+    parser.add_argument('-o', '--outfolder', default=outfolder)
+    parser.add_argument('-c', '--compact', action='store_true',
+                        help='write only in-band rows and their zero brackets')
+    parser.add_argument('-v', '--verify', action='store_true',
+                        help='check compact seds give the same spectrum, '
+                             'implies -c')
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='write gzip compressed narrowband*.sed.gz')
+    args = parser.parse_args()
+    compact = args.compact or args.verify
+
     # Run main program
-    main()
+    main(args.nbands, args.method, args.filterfile, args.threshold,
+         args.edges, args.outfolder, compact, args.verify,
+         args.compress)
 
 
 
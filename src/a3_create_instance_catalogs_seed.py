@@ -10,7 +10,7 @@
 :Depends:
 
   1. ~/phosim/phosim 
-  2. narrowband_seds/*.sed
+  2. narrowband_seds/*.sed (or *.sed.gz with -z)
 
 :Outputs: 
 
@@ -22,16 +22,25 @@
 
   1 second
 
+
+:Usage:
+
+  python a3_create_instance_catalogs_seed.py        # narrowband*.sed
+
+  python a3_create_instance_catalogs_seed.py -z     # after a2 -z
+
 """
 
 # Imports
 import shutil
 import os
 import sys
+from filter_utils import get_filter_id, filters
 
 # Global Variables
 # data is defined in the function.
 outfolder = 'instance_catalogs'
+seddir = '../../../Research/psf_creation_phosim/scripts/narrowband_seds/'
 
 def replace_outfolder(outfolder):
     if os.path.exists(outfolder):
@@ -39,18 +48,32 @@ def replace_outfolder(outfolder):
         shutil.rmtree(outfolder)
     os.makedirs(outfolder)
 
-def create_catalogs():
+def create_catalogs(filter_id=2, nbands=21, outfolder=outfolder,
+                    seddir=seddir, seeds=None, compress=False):
 
     r'''Create catalogs.
     
 :Inputs:
  
-  argument: a number for SIM_SEED
+  seeds: list of SIM_SEED numbers, default one catalog per band with
+  SIM_SEED 1000. With many seeds the catalogs are named e.g.
+  narrowband10_seed1001.icat
+
+  filter_id: lsst filter number or name, e.g. 2 or 'r' (Opsim_filter)
+
+  nbands: number of narrowband seds in seddir
+
+  seddir: sed folder relative to phosim/data/SEDs/
+
+  compress: the seds are gzip compressed narrowband*.sed.gz, written by
+  a2_create_narrowband_seds.py -z
 
 :Outputs:
  
   instance_catalogs/narrowband*.icat
 
+  instance_catalogs/narrowband*_seed*.icat (with seeds)
+
 .. note::
 
   1. This program creates instance catalogs with different SIM_SEED variables.
@@ -79,12 +102,12 @@ Opsim_moonra 180
 Opsim_expmjd 49552.3
 Opsim_moonalt -90
 Opsim_sunalt -90
-Opsim_filter 2
+Opsim_filter {filter_id:d}
 Opsim_dist2moon 180.0
 Opsim_moonphase 10.0
 Opsim_obshistid 99999999
 Opsim_rawseeing 0.65
-SIM_SEED  1000
+SIM_SEED  {seed:d}
 SIM_MINSOURCE 1
 SIM_TELCONFIG 0
 SIM_CAMCONFIG 1
@@ -98,41 +121,55 @@ SIM_NSNAP 1
 
 
     # clobber outfolder
-    outfolder = 'instance_catalogs'
     replace_outfolder(outfolder)
 
 
-    for i in range(21):
-        outfile = outfolder + '/' + 'narrowband' + '{:d}.icat'.format(i)
+    names = ['narrowband{:d}'.format(i) for i in range(nbands)] + ['broadband']
+    if seeds is None:
+        runs = [(name, name, 1000) for name in names]
+    else:
+        runs = [(name + '_seed{:d}'.format(seed), name, seed)
+                for seed in seeds for name in names]
+
+    for catalog, name, seed in runs:
+        outfile = outfolder + '/' + catalog + '.icat'
         print('{} {} {}'.format('creating: ',outfile, ''))
         with open(outfile,'w') as fout:
-            print('{} {} {}'.format('creating: ',outfile, ''))
-            fout.write(data.lstrip())
-            sed  = '../../../Research/psf_creation_phosim/scripts/narrowband_seds/' + 'narrowband' + '{:d}.sed'.format(i)
+            fout.write(data.format(filter_id=get_filter_id(filter_id),
+                                   seed=seed).lstrip())
+            sed  = seddir + name + ('.sed.gz' if compress else '.sed')
             line = 'object 0 0.0 0.0 24 ' + sed + \
                    ' 0 0 0 0 0 0 star none none' + '\n'
 
             fout.write(line)
 
 
-    # for broadband.icat
-    outfile = outfolder + '/' + 'broadband.icat'
-    print('{} {} {}'.format('creating: ',outfile, ''))
-    with open(outfile,'w') as fout:
-        print('{} {} {}'.format('creating: ',outfile, ''))
-        fout.write(data.lstrip())
-        sed  = '../../../Research/psf_creation_phosim/scripts/narrowband_seds/' + 'broadband.sed'
-        line = 'object 0 0.0 0.0 24 ' + sed + \
-               ' 0 0 0 0 0 0 star none none' + '\n'
+    # end function
+    print("Ending: create instance catalogs\n")
 
-        fout.write(line)
+def create_filter_catalogs(nbands=21, names=filters, compress=False):
+    """Create catalogs for many lsst filters in one run.
 
+    The catalogs of filter r go to instance_catalogs_r and use the seds in
+    narrowband_seds_r, and so on for the other filters.
+    """
+    for name in names:
+        create_catalogs(name, nbands, outfolder + '_' + name,
+                        seddir.rstrip('/') + '_' + name + '/',
+                        compress=compress)
 
-    # end function
-    print("Ending: create instance catalogs\n")
 
 if __name__ == '__main__':
-    create_catalogs()
-    pass
+    import argparse
+    parser = argparse.ArgumentParser(description='Create phosim instance catalogs.')
+    parser.add_argument('-f', '--filter', default='2',
+                        help='lsst filter number or name')
+    parser.add_argument('--nbands', type=int, default=21)
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='use the gzip compressed seds of a2 -z')
+    args = parser.parse_args()
+    filter_id = int(args.filter) if args.filter.isdigit() else args.filter
+
+    create_catalogs(filter_id, args.nbands, compress=args.compress)
 
 
@@ -37,6 +37,41 @@
     5. For 21 input instance catalogs this program will create 21 unzipped psfs.
 
     6. We need only electron image and for that we will use a5_unzip_all_psf.py.
+
+    7. The catalogs are run concurrently, the number of phosim runs at the
+       same time (slots) is set by the number of cores and the memory, or
+       by ``--nslots``. Each run has its own phosim work directory and log
+       file inside its output folder and the exit codes are printed at the end.
+
+    8. Phosim is run without a shell, so a mock phosim executable can be
+       used for testing with ``--phosim-dir`` and ``--phosim-exe``.
+
+    9. Outputs of runs whose catalog, seds, background and phosim version
+       did not change are taken from phosim_cache (see phosim_cache.py),
+       use ``--no-cache`` to run phosim anyway.
+
+    10. The status of every run is kept in phosim_journal.json. After a
+        crash, ``--resume`` skips verified done runs, deletes the partial
+        outputs of interrupted runs and retries failed runs up to
+        ``--max-retries`` attempts (see phosim_journal.py).
+
+    11. Wall time, cpu time, peak memory and bytes written of every run are
+        appended to phosim_ledger.csv (see phosim_ledger.py).
+
+    12. With ``--async`` one asyncio controller runs all the catalogs,
+        streams phosim output into the logs, stops runs longer than
+        ``--timeout`` seconds and stops all runs on Ctrl-C (see
+        phosim_async.py).
+
+    13. To share a campaign among several hosts, submit the catalogs to a
+        queue on a shared folder and run workers on every host (see
+        phosim_queue.py).
+
+    14. With ``--order longest`` (default) the runs expected to take longest,
+        estimated from phosim_ledger.csv, are started first so that no
+        slow band is left running alone at the end. The predicted time of
+        the campaign is printed before it starts, runs found in the phosim
+        cache are counted as taking no time.
     
        
 .. warning::
@@ -48,90 +83,333 @@
 """
 
 # Imports
+import argparse
+import asyncio
+import concurrent.futures
+import heapq
 import subprocess  
 import os     
 import shutil 
 import re
 import sys
 import time
+import phosim_cache
+import phosim_ledger
+from phosim_journal import Journal
+from phosim_jobs import (scripts_dir, phosim_dir, phosim_exe, output,
+                         replace_outdir, get_job, get_jobs, get_phosim_command,
+                         call_with_rusage, get_result)
 
-def replace_outdir(outdir):
-    """Replace a folder."""    
-    if os.path.exists(outdir):
-        print('Replacing folder: %s\n'%outdir)
-        shutil.rmtree(outdir)
-        os.makedirs(outdir)
+# Global Variables
+mem_per_run = 2 * 1024**3  # bytes of memory for one phosim run
+
+def get_makespan(seconds, nslots):
+    """Predicted wall time of runs started in the given order on nslots."""
+    slots = [0.0] * nslots
+    for sec in seconds:
+        heapq.heappush(slots, heapq.heappop(slots) + sec)
+    return max(slots)
+
+
+def get_cached_jobs(jobs, cache_dir, phosim_dir=phosim_dir, phosim_exe=phosim_exe):
+    """Names of the jobs whose outputs are in the phosim cache."""
+    cached = set()
+    for job in jobs:
+        try:
+            key = phosim_cache.get_run_key(job, phosim_dir, phosim_exe)
+        except OSError:
+            continue
+        if phosim_cache.is_cached(key, cache_dir):
+            cached.add(job['name'])
+    return cached
+
+
+def order_jobs(jobs, nslots, ledger_file=None, order='longest', cache_dir=None,
+               phosim_dir=phosim_dir, phosim_exe=phosim_exe):
+    """Order jobs longest first from the run times in the ledger.
+
+    Jobs without history get the median estimate of the others. Jobs in
+    the phosim cache (if cache_dir is given) take no time. The predicted
+    makespan of the catalog order and of the new order are printed.
+
+    :Returns: ordered jobs and the estimated seconds of each job.
+    """
+    records = phosim_ledger.read_ledger(ledger_file) if ledger_file else []
+    cached = get_cached_jobs(jobs, cache_dir, phosim_dir, phosim_exe) if cache_dir else set()
+    estimates = {}
+    for job in jobs:
+        if job['name'] in cached:
+            estimates[job['name']] = 0.0
+            continue
+        try:
+            info = phosim_ledger.get_catalog_info(job['catalog'])
+        except (OSError, ValueError, IndexError):
+            info = {}
+        estimates[job['name']] = phosim_ledger.estimate_seconds(job['name'],
+                                                                info, records)
+    known = [sec for name, sec in estimates.items()
+             if sec is not None and name not in cached]
+    if len(cached) == len(jobs):
+        print('All runs are in the phosim cache, keeping the catalog order.')
+        return jobs, estimates
+    if not known:
+        print('No run history in the ledger, keeping the catalog order.')
+        return jobs, estimates
+    fill = sorted(known)[len(known) // 2]
+    for name, sec in estimates.items():
+        if sec is None:
+            estimates[name] = fill
+
+    before = get_makespan([estimates[job['name']] for job in jobs], nslots)
+    if order == 'longest':
+        jobs = sorted(jobs, key=lambda job: -estimates[job['name']])
+    after = get_makespan([estimates[job['name']] for job in jobs], nslots)
+    print('{} {} {}'.format('\nPredicted makespan:', '{:.1f} sec'.format(after),
+                            '({} order, catalog order {:.1f} sec, '
+                            'total {:.1f} sec on {:d} slots, {:d} cached)'.format(
+                                order, before, sum(estimates.values()), nslots,
+                                len(cached))))
+    return jobs, estimates
+
+
+def get_nslots(mem_per_run=mem_per_run):
+    """Get number of phosim runs that fit on this machine.
+
+    The smaller of the number of cores and the memory divided by
+    mem_per_run, at least one.
+    """
+    ncores = os.cpu_count() or 1
+    try:
+        mem = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES')
+    except (ValueError, OSError, AttributeError):
+        return ncores
+    return max(1, min(ncores, mem // mem_per_run))
+
+
+def run_job(job, phosim_dir=phosim_dir, phosim_exe=phosim_exe,
+            cache_dir=None, on_start=None):
+    """Run phosim for one job.
+
+    The stdout and stderr of phosim go to the job logfile.
+
+    If on_start is given phosim is started in its own session and
+    on_start is called with its Popen, e.g. to stop the whole process
+    group with os.killpg (see phosim_queue).
+
+    If cache_dir is given and the same inputs were run before, the cached
+    outputs are linked into the output folder instead of running phosim,
+    see phosim_cache.
+
+    :Returns: dictionary with name, returncode, seconds, logfile, cached
+        and the resources used by phosim: user_sec, sys_sec, maxrss_bytes,
+        out_bytes and write_blocks.
+    """
+    print('{} {} {}'.format('\n Begin running Phosim for catalog :', job['name'], ''))
+    begin_time = time.time()
+
+    if cache_dir:
+        key = phosim_cache.get_run_key(job, phosim_dir, phosim_exe)
+        if phosim_cache.fetch(key, job['outdir'], cache_dir):
+            print('{} {} {}'.format(' Using cached output for catalog  :', job['name'], key))
+            return {'name': job['name'], 'returncode': 0,
+                    'seconds': time.time() - begin_time,
+                    'logfile': job['logfile'], 'cached': True}
+
+    if not os.path.exists(job['workdir']):
+        os.makedirs(job['workdir'])
+
+    commands = get_phosim_command(job, phosim_exe)
+    rusage = None
+    with open(job['logfile'], 'w') as log:
+        log.write(' '.join(commands) + '\n')
+        log.flush()
+        try:
+            returncode, rusage = call_with_rusage(commands, on_start,
+                                                  cwd=phosim_dir,
+                                                  stdout=log,
+                                                  stderr=subprocess.STDOUT,
+                                                  start_new_session=on_start is not None)
+        except OSError as e:
+            log.write('Could not run phosim: %s\n' % e)
+            returncode = -1
+
+    # work files are not needed after the run
+    if returncode == 0:
+        shutil.rmtree(job['workdir'], ignore_errors=True)
+        if cache_dir:
+            phosim_cache.store(key, job['outdir'], job['name'], cache_dir)
+
+    seconds = time.time() - begin_time
+    print('{} {} {}'.format('\n End running Phosim for catalog :', job['name'],
+                            'exit code {:d}, {:.1f} sec'.format(returncode, seconds)))
+    return get_result(job, returncode, seconds, rusage)
+
+
+def run_journal_job(job, phosim_dir=phosim_dir, phosim_exe=phosim_exe,
+                    cache_dir=None, journal=None):
+    """Run one job and record its status in the journal, if any."""
+    if journal is None:
+        return run_job(job, phosim_dir, phosim_exe, cache_dir)
+
+    journal.mark_running(job)
+    try:
+        result = run_job(job, phosim_dir, phosim_exe, cache_dir)
+    except Exception:
+        journal.mark_failed(job, -1)
+        raise
+    if result['returncode'] == 0:
+        journal.mark_done(job)
     else:
-        print('Making new folder: %s\n'%outdir)
-        os.makedirs(outdir)
+        journal.mark_failed(job, result['returncode'])
+    return result
+
+
+def run_jobs(jobs, nslots=None, phosim_dir=phosim_dir, phosim_exe=phosim_exe,
+             cache_dir=None, journal=None, ledger_file=None, on_result=None):
+    """Run phosim jobs concurrently, nslots at a time.
+
+    :Usage: results = run_jobs(get_jobs(), nslots=8)
+
+    nslots defaults to get_nslots(). The output folder of every job is
+    replaced before its run. cache_dir is passed to run_job. If journal
+    (phosim_journal.Journal) is given the status of every run is recorded.
+    If ledger_file is given the resources of every run are appended to it
+    together with the band, seed, vistime and magnitude (see phosim_ledger).
+    If on_result is given it is called as on_result(job, result) as soon
+    as each run finishes, always from the calling thread.
+    """
+    if nslots is None:
+        nslots = get_nslots()
+    print('{} {} {}'.format('\nRunning', len(jobs), 'phosim jobs on {:d} slots'.format(nslots)))
+
+    for job in jobs:
+        replace_outdir(job['outdir'])
+
+    results = []
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nslots) as pool:
+        futures = [pool.submit(run_journal_job, job, phosim_dir, phosim_exe,
+                               cache_dir, journal)
+                   for job in jobs]
+        jobs_of = dict(zip(futures, jobs))
+        for future in concurrent.futures.as_completed(futures):
+            result = future.result()
+            results.append(result)
+            if ledger_file:
+                record = phosim_ledger.get_record(jobs_of[future], result)
+                phosim_ledger.append_record(record, ledger_file)
+            if on_result is not None:
+                on_result(jobs_of[future], result)
 
-def run_phosim():
-    '''Run the phosim program.
+    print_summary(jobs, results)
+    return results
+
+
+def print_summary(jobs, results):
+    """Print exit code and time of every run in the job order."""
+    order = {job['name']: i for i, job in enumerate(jobs)}
+    results.sort(key=lambda r: order[r['name']])
+    print('\n{:<16s} {:>6s} {:>10s} {:>7s}'.format('catalog', 'exit', 'seconds', 'cached'))
+    for r in results:
+        print('{:<16s} {:>6d} {:>10.1f} {:>7s}'.format(r['name'], r['returncode'],
+                                                  r['seconds'], str(r['cached'])))
+
+
+def run_phosim(nslots=1):
+    '''Run the phosim program for the narrowband catalogs.
 
     '''
     
     # clobber output folder 
-    output = 'phosim_output_zipped'
     if os.path.exists(output):
         shutil.rmtree(output)
     os.makedirs(output)
 
-    # catalogs
-    for i in range(21):
-        
-        subprogram = 'narrowband{:d}'.format(i)
-        print('{} {} {}'.format('\n\n Begin running Phosim for catalog :',subprogram, '\n\n'))
-    
-    
-        # create output dir
-        outputdir1 = output + '/narrowband{:d}_out'.format(i)
-        os.makedirs(outputdir1)
-    
-        # commands to run relative to phosim installation folder
-        instance_catalog  = '/Users/poudel/Research/psf_creation_phosim/scripts/' + \
-                            'instance_catalogs/' + \
-                            'narrowband{:d}.icat'.format(i)
-                  
-        background        = '/Users/poudel/Research/psf_creation_phosim/scripts/' +\
-                            'backgrounds/background1.bkg'
-        
-        outputdir2        = '/Users/poudel/Research/psf_creation_phosim/scripts/' + outputdir1
-        
-        commands = 'cd ~/phosim;' + \
-                   ' ./phosim '   + instance_catalog + \
-                   ' -c '         + background + \
-                   ' -o '         + outputdir2
-              
-    
-        # run the program
-        subprocess.call(commands,shell=True)
-        
-        print('{} {} {}'.format('\n\n End running Phosim for catalog :',subprogram, '\n\n'))
-        
- 
-
+    jobs = [job for job in get_jobs() if job['name'] != 'broadband']
+    return run_jobs(jobs, nslots)
 
 
 def run_phosim_broadband():
     """ Run phosim for broadband sed. """
-    print('{} {} {}'.format('\n\n Begin running Phosim for catalog :','broadband', '\n\n'))
+    return run_jobs([get_job('broadband')], 1)
 
-    # output dir
-    outputdir1         = 'phosim_output_zipped/broadband_out'
-    replace_outdir(outputdir1)
-    
-    # phosim command arguments relative to phosim installtion directory
-    instance_catalog  = '/Users/poudel/Research/psf_creation_phosim/scripts/instance_catalogs/broadband.icat'          
-    background        = '/Users/poudel/Research/psf_creation_phosim/scripts/backgrounds/background1.bkg'
-    outputdir2        = '/Users/poudel/Research/psf_creation_phosim/scripts/phosim_output_zipped/broadband_out'
-    
-    commands = r'cd ~/phosim;' + \
-           r' ./phosim ' + instance_catalog + \
-           r' -c '       + background + \
-           r' -o '       + outputdir2
-           
-    subprocess.call(commands,shell=True)
-    print('{} {} {}'.format('\n\n End running Phosim for catalog :','broadband', '\n\n'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Run phosim for all catalogs.')
+    parser.add_argument('-n', '--nslots', type=int, default=None,
+                        help='number of phosim runs at the same time')
+    parser.add_argument('--nbands', type=int, default=21)
+    parser.add_argument('--scripts-dir', default=scripts_dir)
+    parser.add_argument('--phosim-dir', default=phosim_dir)
+    parser.add_argument('--phosim-exe', default=phosim_exe)
+    parser.add_argument('--cache-dir', default=None,
+                        help='reuse outputs of runs with unchanged inputs, '
+                             'default scripts_dir/phosim_cache')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always run phosim')
+    parser.add_argument('--journal', default=None,
+                        help='run journal, default scripts_dir/phosim_journal.json')
+    parser.add_argument('--resume', action='store_true',
+                        help='skip verified done runs, retry failed and '
+                             'interrupted runs')
+    parser.add_argument('--max-retries', type=int, default=3)
+    parser.add_argument('--async', dest='use_async', action='store_true',
+                        help='run with the asyncio driver, see phosim_async')
+    parser.add_argument('--timeout', type=float, default=None,
+                        help='stop a run after this many seconds (with --async)')
+    parser.add_argument('--echo', action='store_true',
+                        help='print phosim output lines live (with --async)')
+    parser.add_argument('--order', choices=['longest', 'catalog'],
+                        default='longest',
+                        help='start the runs expected to take longest first')
+    parser.add_argument('--ledger', default=None,
+                        help='csv ledger of resources used by every run, '
+                             'default scripts_dir/phosim_ledger.csv')
+    args = parser.parse_args()
+    ledger_file = args.ledger or os.path.join(args.scripts_dir,
+                                              phosim_ledger.ledger_file)
+
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(args.scripts_dir,
+                                                   phosim_cache.cache_dir)
+
+    jobs = get_jobs(args.nbands, args.scripts_dir)
+    journal = Journal(args.journal or os.path.join(args.scripts_dir,
+                                                   'phosim_journal.json'),
+                      args.max_retries)
+
+    if args.resume:
+        jobs = journal.plan_resume(jobs)
+    else:
+        # clobber output folder
+        outdir = os.path.join(args.scripts_dir, output)
+        if os.path.exists(outdir):
+            shutil.rmtree(outdir)
+        os.makedirs(outdir)
+        journal.reset(jobs)
+
+    nslots = args.nslots or get_nslots()
+    jobs, estimates = order_jobs(jobs, nslots, ledger_file, args.order,
+                                 cache_dir, args.phosim_dir, args.phosim_exe)
+
+    if args.use_async:
+        import phosim_async
+        for job in jobs:
+            replace_outdir(job['outdir'])
+        try:
+            results = phosim_async.run_jobs(jobs, nslots, args.phosim_dir,
+                                            args.phosim_exe, args.timeout,
+                                            cache_dir, journal, ledger_file,
+                                            args.echo)
+        except (KeyboardInterrupt, asyncio.CancelledError):
+            print('Stopped, use --resume to continue the campaign.')
+            sys.exit(130)
+        print_summary(jobs, results)
+    else:
+        results = run_jobs(jobs, nslots, args.phosim_dir, args.phosim_exe,
+                           cache_dir, journal, ledger_file)
+    print('{} {} {}'.format('\njournal:', journal.path, journal.summary()))
+    return results
 
 
 if __name__ == '__main__':
@@ -141,8 +419,7 @@ if __name__ == '__main__':
     program_begin_time = time.time()
     begin_ctime        = time.ctime()
     
-    run_phosim()
-    run_phosim_broadband()
+    results = main()
 
 
     # print the time taken
@@ -156,4 +433,6 @@ if __name__ == '__main__':
     print('End   time: ', end_ctime,'\n')
     print("Time taken: {0:.0f} days, {1:.0f} hours, \
           {2:.0f} minutes, {3:f} seconds.".format(d, h, m, s))
-    
+
+    # exit code is not zero if any phosim run failed
+    sys.exit(1 if any(r['returncode'] != 0 for r in results) else 0)
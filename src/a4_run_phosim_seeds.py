@@ -0,0 +1,225 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 10, 2017 Thu
+# Last update :
+"""This program runs every band with many seeds and keeps the mean and variance psf.
+
+:Depends:
+    narrowband_seds/*.sed
+
+    backgrounds/background1.bkg
+
+:Outputs:
+    instance_catalogs_seeds/narrowband*_seed*.icat
+
+    phosim_output_ensemble/narrowband*_mean.fits
+
+    phosim_output_ensemble/narrowband*_var.fits
+
+:Info:
+
+  1. The catalogs of M seeds, e.g. 1000 to 1049, are written by
+     a3.create_catalogs and run with a4.run_jobs.
+
+  2. As soon as the run of one seed finishes its electron image is added to
+     the running per pixel mean and variance of its band (Welford), then
+     its output folder is deleted unless ``--keep`` is given.
+
+  3. The runs are started band after band, and a band is written and freed
+     when its last seed finished. A band in progress holds two float64
+     full chip arrays (about 2 x 130 MB for a 4000 x 4072 chip), and only
+     the bands whose seeds are running at the same time, about
+     nslots / M + 2, are in memory, whatever M and the number of bands.
+
+  4. The variance is the sample variance (ddof=1) between seeds, the
+     header keyword NSEED has the number of seeds in the mean.
+
+:Usage:
+    python a4_run_phosim_seeds.py -m 50 --first-seed 1000 -n 8
+
+"""
+
+# Imports
+import argparse
+import os
+import shutil
+import time
+from astropy.io import fits
+import numpy as np
+import a4_run_phosim_all_catalogs as a4
+from a3_create_instance_catalogs_seed import create_catalogs, seddir
+from a5_unzip_all_psf import psf_name
+from phosim_ledger import get_catalog_info
+
+# Global Variables
+catalog_dir = 'instance_catalogs_seeds'
+ensemble_dir = 'phosim_output_ensemble'
+
+
+class RunningStats(object):
+    """Running per pixel mean and variance of images (Welford).
+
+    :Usage:
+      stats = RunningStats()
+
+      stats.update(data)   # for each image
+
+      mean, var = stats.mean, stats.variance()
+    """
+
+    def __init__(self):
+        self.count = 0
+        self.mean = None
+        self.m2 = None
+
+    def update(self, data):
+        """Add one image, the update is done in place in float64."""
+        data = np.array(data, dtype='float64')
+        if self.mean is None:
+            self.mean = np.zeros(data.shape, dtype='float64')
+            self.m2 = np.zeros(data.shape, dtype='float64')
+        self.count += 1
+        delta = data - self.mean
+        self.mean += delta / self.count
+        # m2 += delta * (data - new mean), without a second temporary
+        data -= self.mean
+        data *= delta
+        self.m2 += data
+
+    def variance(self, ddof=1):
+        if self.count <= ddof:
+            return np.zeros_like(self.mean)
+        return self.m2 / (self.count - ddof)
+
+    def write(self, outprefix, header=None):
+        """Write outprefix_mean.fits and outprefix_var.fits."""
+        outfiles = []
+        for kind, data in [('mean', self.mean), ('var', self.variance())]:
+            hdu = fits.PrimaryHDU(data, header=header)
+            hdu.header['NSEED'] = (self.count, 'number of seeds')
+            outfile = '{}_{}.fits'.format(outprefix, kind)
+            hdu.writeto(outfile, overwrite=True)
+            outfiles.append(outfile)
+        return outfiles
+
+
+def get_seed_jobs(seeds, nbands=21, filter_id=2, scripts_dir=a4.scripts_dir,
+                  compress=False):
+    """Write the catalogs of all the seeds and get their a4 jobs.
+
+    compress is passed to a3.create_catalogs (seds of a2 -z).
+
+    :Returns: list of (job, band name, seed).
+    """
+    outfolder = os.path.join(scripts_dir, catalog_dir)
+    create_catalogs(filter_id, nbands, outfolder, seddir, seeds, compress)
+
+    # band after band, so that the seeds of a band finish close together
+    names = ['narrowband{:d}'.format(i) for i in range(nbands)] + ['broadband']
+    runs = []
+    for name in names:
+        for seed in seeds:
+            job = a4.get_job('{}_seed{:d}'.format(name, seed), scripts_dir)
+            job['catalog'] = os.path.join(outfolder, job['name'] + '.icat')
+            runs.append((job, name, seed))
+    return runs
+
+
+def run_seeds(seeds, nbands=21, filter_id=2, nslots=None, keep=False,
+              scripts_dir=a4.scripts_dir, phosim_dir=a4.phosim_dir,
+              phosim_exe=a4.phosim_exe, ledger_file=None, compress=False):
+    """Run all bands for all seeds and write the mean and variance psfs.
+
+    The psfs of a band are written and its arrays freed as soon as all its
+    seeds finished.
+
+    :Returns: dictionary of band name to number of seeds in the mean.
+    """
+    runs = get_seed_jobs(seeds, nbands, filter_id, scripts_dir, compress)
+    band_of = {job['name']: (name, seed) for job, name, seed in runs}
+    remaining = {}
+    for job, name, seed in runs:
+        remaining[name] = remaining.get(name, 0) + 1
+    stats = {}
+    counts = {}
+    failed = []
+
+    outdir = os.path.join(scripts_dir, ensemble_dir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+
+    def add_result(job, result):
+        name, seed = band_of[job['name']]
+        remaining[name] -= 1
+        if result['returncode'] != 0:
+            failed.append(job['name'])
+        else:
+            psf_file = os.path.join(job['outdir'],
+                                    psf_name.format(get_catalog_info(job['catalog'])['filter']))
+            stats.setdefault(name, RunningStats()).update(fits.getdata(psf_file))
+            print('{} {} {}'.format('added seed', seed, 'to {} ({:d} seeds)'.format(
+                name, stats[name].count)))
+            if not keep:
+                shutil.rmtree(job['outdir'], ignore_errors=True)
+
+        # last seed of the band, write it and free its arrays
+        if remaining[name] == 0 and name in stats:
+            band = stats.pop(name)
+            counts[name] = band.count
+            for outfile in band.write(os.path.join(outdir, name)):
+                print('{} {} {}'.format('Creating file: ', outfile, ''))
+
+    a4.run_jobs([job for job, name, seed in runs], nslots, phosim_dir,
+                phosim_exe, ledger_file=ledger_file, on_result=add_result)
+
+    if failed:
+        print('{} {} {}'.format('\nFailed runs, not in the mean:', len(failed),
+                                ', '.join(failed)))
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run all bands for many seeds '
+                                                 'and keep mean and variance psfs.')
+    parser.add_argument('-m', '--nseeds', type=int, default=50)
+    parser.add_argument('--first-seed', type=int, default=1000)
+    parser.add_argument('--nbands', type=int, default=21)
+    parser.add_argument('-f', '--filter', default='2',
+                        help='lsst filter number or name')
+    parser.add_argument('-n', '--nslots', type=int, default=None)
+    parser.add_argument('--keep', action='store_true',
+                        help='keep the phosim outputs of every seed')
+    parser.add_argument('--scripts-dir', default=a4.scripts_dir)
+    parser.add_argument('--phosim-dir', default=a4.phosim_dir)
+    parser.add_argument('--phosim-exe', default=a4.phosim_exe)
+    parser.add_argument('--ledger', default=None)
+    parser.add_argument('-z', '--compress', action='store_true',
+                        help='use the gzip compressed seds of a2 -z')
+    args = parser.parse_args()
+
+    filter_id = int(args.filter) if args.filter.isdigit() else args.filter
+    seeds = list(range(args.first_seed, args.first_seed + args.nseeds))
+    run_seeds(seeds, args.nbands, filter_id, args.nslots, args.keep,
+              args.scripts_dir, args.phosim_dir, args.phosim_exe, args.ledger,
+              args.compress)
+
+
+if __name__ == '__main__':
+
+    # beginning time
+    begin_time,begin_ctime = time.time(), time.ctime()
+
+    # run main program
+    main()
+
+    # print the time taken
+    end_time,end_ctime  = time.time(), time.ctime()
+    seconds             = end_time - begin_time
+    m, s                = divmod(seconds, 60)
+    h, m                = divmod(m, 60)
+    d, h                = divmod(h, 24)
+    print('\nBegin time: ', begin_ctime,'\nEnd   time: ', end_ctime,'\n' )
+    print("Time taken: {0:.0f} days, {1:.0f} hours, \
+          {2:.0f} minutes, {3:f} seconds.".format(d, h, m, s))
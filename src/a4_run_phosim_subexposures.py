@@ -0,0 +1,240 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 07, 2017 Mon
+# Last update :
+"""This program splits the exposure of one band in parallel sub-exposures.
+
+:Depends:
+    instance_catalogs/narrowband*.icat
+
+    a4_run_phosim_all_catalogs.py
+
+:Outputs:
+    instance_catalogs/narrowband*_sub*.icat
+
+    phosim_output_zipped/narrowband*_sub*_out/
+
+    phosim_output_zipped/narrowband*_validate_out/
+
+    phosim_output_coadd/narrowband*.fits
+
+    phosim_output_coadd/narrowband*_report.json
+
+:Info:
+
+  1. The catalog of a band has one long exposure, e.g. SIM_VISTIME 300.
+     Here it is split in K catalogs with SIM_VISTIME 300/K, each with its
+     own seed derived from SIM_SEED, and the K phosim runs are run at the
+     same time with a4.run_jobs. The vistimes are written in full
+     precision and the last one gets the remainder, so they add up to
+     the exposure of the band.
+
+  2. The K electron images are added to one psf with the same total
+     exposure as the single long run.
+
+  3. With ``--validate`` the single long run of the band is also run (or
+     taken from the phosim cache) into narrowband*_validate_out, so the
+     campaign output narrowband*_out is kept, and a report compares the
+     co-add with it: total electrons, centroid, second moments and pixel
+     residuals. The two are different photon realizations, so they agree
+     only within the photon noise.
+
+  4. As in a4, the phosim cache is scripts_dir/phosim_cache unless
+     ``--cache-dir`` or ``--no-cache`` is given.
+
+:Usage:
+    python a4_run_phosim_subexposures.py narrowband10 -k 8 --validate
+
+"""
+
+# Imports
+import argparse
+import hashlib
+import json
+import os
+import time
+from astropy.io import fits
+import numpy as np
+import a4_run_phosim_all_catalogs as a4
+import phosim_cache
+from a5_unzip_all_psf import psf_name
+from phosim_ledger import get_catalog_info
+from psf_index import get_moments
+
+# Global Variables
+coadd_dir = 'phosim_output_coadd'
+
+
+def derive_seed(seed, k):
+    """Get a seed for sub-exposure k, different for every seed and k."""
+    digest = hashlib.sha1('{:d}:{:d}'.format(seed, k).encode()).hexdigest()
+    return int(digest[:8], 16) % 2147483647 + 1
+
+
+def write_subexposure_catalogs(job, nsub, scripts_dir=a4.scripts_dir):
+    """Write nsub catalogs with 1/nsub of the exposure and derived seeds.
+
+    :Returns: list of a4 jobs of the sub-exposures.
+    """
+    with open(job['catalog'], 'r') as f:
+        lines = f.readlines()
+    info = get_catalog_info(job['catalog'])
+
+    # full precision, the last sub-exposure gets the remainder
+    vistime = info['vistime'] / nsub
+    vistimes = [vistime] * (nsub - 1) + [info['vistime'] - vistime * (nsub - 1)]
+
+    subjobs = []
+    for k in range(nsub):
+        subjob = a4.get_job('{}_sub{:d}'.format(job['name'], k), scripts_dir)
+        with open(subjob['catalog'], 'w') as fout:
+            for line in lines:
+                row = line.split()
+                if row and row[0] == 'SIM_SEED':
+                    line = 'SIM_SEED {:d}\n'.format(derive_seed(info['seed'], k))
+                elif row and row[0] == 'SIM_VISTIME':
+                    line = 'SIM_VISTIME {!r}\n'.format(vistimes[k])
+                fout.write(line)
+        subjobs.append(subjob)
+        print('{} {} {}'.format('creating: ', subjob['catalog'], ''))
+    return subjobs
+
+
+def get_psf_file(job):
+    """Get the phosim electron image of a job."""
+    filter_id = get_catalog_info(job['catalog'])['filter']
+    return os.path.join(job['outdir'], psf_name.format(filter_id))
+
+
+def coadd_subexposures(subjobs, outfile):
+    """Add the electron images of the sub-exposures and write the co-add."""
+    total = None
+    for subjob in subjobs:
+        data = fits.getdata(get_psf_file(subjob))
+        if total is None:
+            total = np.zeros(data.shape, dtype='float64')
+        total += data
+
+    hdu = fits.PrimaryHDU(total)
+    hdu.header['NCOADD'] = (len(subjobs), 'number of co-added sub-exposures')
+    for k, subjob in enumerate(subjobs):
+        hdu.header['SEED{:d}'.format(k)] = get_catalog_info(subjob['catalog'])['seed']
+    hdu.writeto(outfile, overwrite=True)
+    print('{} {} {}'.format('\nCreating file: ', outfile, ''))
+    return total
+
+
+def compare_psf(coadd, single):
+    """Compare the co-added psf with the single long run.
+
+    :Returns: dictionary of the comparison, residuals are of the psfs
+        normalized to unit sum. expected_rms is the residual rms expected
+        from the photon noise of the two images alone.
+    """
+    ctotal, ccen, cmom = get_moments(coadd)
+    stotal, scen, smom = get_moments(single)
+    residual = coadd / ctotal - single / stotal
+    return {'total_coadd'      : ctotal,
+            'total_single'     : stotal,
+            'total_ratio'      : ctotal / stotal,
+            'centroid_coadd'   : list(ccen),
+            'centroid_single'  : list(scen),
+            'centroid_shift'   : float(np.hypot(ccen[0] - scen[0], ccen[1] - scen[1])),
+            'moments_coadd'    : list(cmom),
+            'moments_single'   : list(smom),
+            'residual_rms'     : float(np.sqrt(np.mean(residual**2))),
+            'residual_max'     : float(np.abs(residual).max()),
+            'expected_rms'     : float(np.sqrt(np.mean(coadd / ctotal**2 +
+                                                           single / stotal**2)))}
+
+
+def run_subexposures(name, nsub, nslots=None, validate=False,
+                     scripts_dir=a4.scripts_dir, phosim_dir=a4.phosim_dir,
+                     phosim_exe=a4.phosim_exe, cache_dir=None):
+    """Run one band as nsub parallel sub-exposures and co-add them.
+
+    :Returns: the co-added image and the validation report (or None).
+    """
+    job = a4.get_job(name, scripts_dir)
+    subjobs = write_subexposure_catalogs(job, nsub, scripts_dir)
+
+    runs = list(subjobs)
+    if validate:
+        # the outputs of the campaign (a4) in name_out are not touched
+        single = a4.get_job(name + '_validate', scripts_dir)
+        single['catalog'] = job['catalog']
+        runs.append(single)
+    results = a4.run_jobs(runs, nslots or len(runs), phosim_dir, phosim_exe,
+                          cache_dir)
+    failed = [r['name'] for r in results if r['returncode'] != 0]
+    if failed:
+        raise RuntimeError('phosim failed for: %s' % ', '.join(failed))
+
+    outdir = os.path.join(scripts_dir, coadd_dir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    coadd = coadd_subexposures(subjobs, os.path.join(outdir, name + '.fits'))
+
+    report = None
+    if validate:
+        report = compare_psf(coadd, fits.getdata(get_psf_file(single)))
+        report.update({'band': name, 'nsub': nsub,
+                       'seconds': {r['name']: r['seconds'] for r in results}})
+        reportfile = os.path.join(outdir, name + '_report.json')
+        with open(reportfile, 'w') as f:
+            json.dump(report, f, indent=1)
+        for key in ('total_ratio', 'centroid_shift', 'residual_rms',
+                    'expected_rms'):
+            print('{:<18s} : {}'.format(key, report[key]))
+        print('{} {} {}'.format('\nCreating file: ', reportfile, ''))
+
+    return coadd, report
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run one band as parallel '
+                                                 'sub-exposures and co-add them.')
+    parser.add_argument('name', help='catalog name, e.g. narrowband10')
+    parser.add_argument('-k', '--nsub', type=int, default=4,
+                        help='number of sub-exposures')
+    parser.add_argument('-n', '--nslots', type=int, default=None)
+    parser.add_argument('--validate', action='store_true',
+                        help='also run the single long exposure and compare')
+    parser.add_argument('--scripts-dir', default=a4.scripts_dir)
+    parser.add_argument('--phosim-dir', default=a4.phosim_dir)
+    parser.add_argument('--phosim-exe', default=a4.phosim_exe)
+    parser.add_argument('--cache-dir', default=None,
+                        help='default scripts_dir/phosim_cache')
+    parser.add_argument('--no-cache', action='store_true',
+                        help='always run phosim')
+    args = parser.parse_args()
+
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = args.cache_dir or os.path.join(args.scripts_dir,
+                                                   phosim_cache.cache_dir)
+
+    run_subexposures(args.name, args.nsub, args.nslots, args.validate,
+                     args.scripts_dir, args.phosim_dir, args.phosim_exe,
+                     cache_dir)
+
+
+if __name__ == '__main__':
+
+    # beginning time
+    begin_time,begin_ctime = time.time(), time.ctime()
+
+    # run main program
+    main()
+
+    # print the time taken
+    end_time,end_ctime  = time.time(), time.ctime()
+    seconds             = end_time - begin_time
+    m, s                = divmod(seconds, 60)
+    h, m                = divmod(m, 60)
+    d, h                = divmod(h, 24)
+    print('\nBegin time: ', begin_ctime,'\nEnd   time: ', end_ctime,'\n' )
+    print("Time taken: {0:.0f} days, {1:.0f} hours, \
+          {2:.0f} minutes, {3:f} seconds.".format(d, h, m, s))
@@ -0,0 +1,189 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 12, 2017 Sat
+# Last update :
+""" This program cuts postage stamps of the psf from the zipped phosim outputs.
+
+:Inputs:
+  phosim_output_zipped/narrowband*_out/lsst_e_99999999_f2_R22_S11_E000.fits.gz
+
+:Outputs:
+  phosim_output_stamps/psf*.fits
+
+  phosim_output_stamps/broadband.fits
+
+:Info:
+
+  1. Each zipped full chip image is read once, the psf is located by its
+     brightest pixel (peak) or by the centroid of a box around the peak
+     (centroid), and only a size x size stamp around it is written.
+
+  2. The stamps have the same names as the outputs of a5_unzip_all_psf.py,
+     so a6 can normalize them with indir = 'phosim_output_stamps'.
+
+  3. The header of the stamp is the phosim header with the stamp offsets:
+     STAMPX0, STAMPY0 are the 0-based chip pixel of stamp pixel (0, 0),
+     LTV1, LTV2 are the iraf physical offsets and CRPIX1, CRPIX2 are
+     shifted if present. PSFX, PSFY are the psf position on the chip.
+
+  4. A stamp near the chip edge is moved inside the chip, its offsets
+     tell where it was cut.
+
+  5. The statistics of the stamps are written to
+     phosim_output_stamps/psf_index.json (see psf_index.py).
+
+:Usage:
+    python a5_extract_psf_stamps.py -s 128 -m centroid
+
+"""
+
+# Imports
+import argparse
+import concurrent.futures
+import os
+import shutil
+import time
+from astropy.io import fits
+import numpy as np
+from a5_unzip_all_psf import psf_name
+from filter_utils import get_filter_id
+from psf_index import PsfIndex
+
+# Global Variables
+outdir = 'phosim_output_stamps'
+
+
+def locate_psf(data, method='centroid', size=128):
+    """Get the (x, y) chip position of the psf, 0-based.
+
+    peak is the brightest pixel, centroid is the flux weighted center of
+    the size x size box around the peak.
+    """
+    y, x = np.unravel_index(np.argmax(data), data.shape)
+    if method == 'peak':
+        return float(x), float(y)
+
+    y0, x0 = get_stamp_origin(data.shape, x, y, size)
+    box = np.asarray(data[y0:y0 + size, x0:x0 + size], dtype='float64')
+    total = box.sum()
+    if total <= 0:
+        return float(x), float(y)
+    yy, xx = np.indices(box.shape)
+    return x0 + (box * xx).sum() / total, y0 + (box * yy).sum() / total
+
+
+def get_stamp_origin(shape, x, y, size):
+    """Chip pixel (y0, x0) of the stamp corner, moved inside the chip."""
+    ny, nx = shape
+    if size > nx or size > ny:
+        raise ValueError('stamp size %d larger than image %s' % (size, shape))
+    x0 = min(max(int(round(x)) - size // 2, 0), nx - size)
+    y0 = min(max(int(round(y)) - size // 2, 0), ny - size)
+    return y0, x0
+
+
+def extract_stamp(infile, outfile, size=128, method='centroid', index=None):
+    """Cut the psf stamp of one phosim output and write it.
+
+    If index (psf_index.PsfIndex) is given the stamp is added to it.
+
+    :Returns: (outfile, x0, y0, psf x, psf y)
+    """
+    with fits.open(infile, memmap=False) as hdul:
+        header = hdul[0].header.copy()
+        data = hdul[0].data
+
+    x, y = locate_psf(data, method, size)
+    y0, x0 = get_stamp_origin(data.shape, x, y, size)
+    stamp = np.ascontiguousarray(data[y0:y0 + size, x0:x0 + size])
+    del data
+
+    for key, offset in [('CRPIX1', x0), ('CRPIX2', y0)]:
+        if key in header:
+            header[key] = header[key] - offset
+    header['STAMPX0'] = (x0, 'chip x of stamp pixel 0 (0-based)')
+    header['STAMPY0'] = (y0, 'chip y of stamp pixel 0 (0-based)')
+    header['LTV1'] = (-x0, 'stamp x = chip x + LTV1')
+    header['LTV2'] = (-y0, 'stamp y = chip y + LTV2')
+    header['PSFX'] = (x, 'psf x on the chip (0-based, %s)' % method)
+    header['PSFY'] = (y, 'psf y on the chip (0-based, %s)' % method)
+    header['STAMPSRC'] = (os.path.basename(infile)[:68], 'stamp cut from')
+
+    fits.PrimaryHDU(stamp, header=header).writeto(outfile, overwrite=True)
+    if index is not None:
+        index.add(outfile, stamp)
+    return outfile, x0, y0, x, y
+
+
+def extract_stamps(filter_id=2, nbands=21, size=128, method='centroid',
+                   nworkers=None, indir='phosim_output_zipped', outdir=outdir):
+    """Cut the psf stamps of all narrowbands and the broadband.
+
+    The files are read at the same time on nworkers threads.
+    """
+    print('{} {} {}'.format('\nRunning a5_extract_psf_stamps', size, method))
+
+    # Clobber outdir
+    if os.path.exists(outdir):
+        shutil.rmtree(outdir)
+    os.makedirs(outdir)
+
+    name = psf_name.format(get_filter_id(filter_id))
+    pairs = [(os.path.join(indir, 'narrowband{:d}_out'.format(i), name),
+              os.path.join(outdir, 'psf{:d}.fits'.format(i)))
+             for i in range(nbands)]
+    pairs.append((os.path.join(indir, 'broadband_out', name),
+                  os.path.join(outdir, 'broadband.fits')))
+
+    index = PsfIndex(outdir)
+    nworkers = nworkers or min(len(pairs), os.cpu_count() or 1)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as pool:
+        futures = [pool.submit(extract_stamp, infile, outfile, size, method, index)
+                   for infile, outfile in pairs]
+        results = [future.result() for future in futures]
+    index.save()
+
+    for outfile, x0, y0, x, y in results:
+        print('{} {} {}'.format('outfile: ', outfile,
+                                'psf at ({:.2f}, {:.2f}), cut at ({:d}, {:d})'.format(x, y, x0, y0)))
+    print('{} {} {}'.format('\nEnd of a5_extract_psf_stamps','', ''))
+    return results
+
+
+if __name__ == '__main__':
+
+    # beginning time
+    program_begin_time = time.time()
+    begin_ctime        = time.ctime()
+
+    parser = argparse.ArgumentParser(description='Cut psf stamps from zipped '
+                                                 'phosim outputs.')
+    parser.add_argument('-s', '--size', type=int, default=128,
+                        help='stamp size in pixels')
+    parser.add_argument('-m', '--method', default='centroid',
+                        choices=['centroid', 'peak'])
+    parser.add_argument('-f', '--filter', default='2',
+                        help='lsst filter number or name')
+    parser.add_argument('--nbands', type=int, default=21)
+    parser.add_argument('-n', '--nworkers', type=int, default=None)
+    parser.add_argument('-o', '--outdir', default=outdir)
+    args = parser.parse_args()
+    filter_id = int(args.filter) if args.filter.isdigit() else args.filter
+
+    # run main
+    extract_stamps(filter_id, args.nbands, args.size, args.method,
+                   args.nworkers, outdir=args.outdir)
+
+    # print the time taken
+    program_end_time = time.time()
+    end_ctime        = time.ctime()
+    seconds          = program_end_time - program_begin_time
+    m, s             = divmod(seconds, 60)
+    h, m             = divmod(m, 60)
+    d, h             = divmod(h, 24)
+    print('\nBegin time: ', begin_ctime)
+    print('End   time: ', end_ctime,'\n')
+    print("Time taken: {0:.0f} days, {1:.0f} hours, \
+          {2:.0f} minutes, {3:f} seconds.".format(d, h, m, s))
@@ -11,22 +11,176 @@
 :Outputs: 
   phosim_output_unzipped/psf*.fits
 
+  phosim_output_unzipped/psf_index.json
+
 :Runtime: 
   12 seconds
   
+:Info:
+
+  1. Every file is decompressed in chunks of chunk_size bytes, so the
+     memory used does not depend on the image size.
+
+  2. Many files are decompressed at the same time on a thread pool, zlib
+     releases the GIL while it works.
+
+  3. The fits structure (header blocks, END card and data size of every
+     hdu) is checked while the chunks are written. A truncated or corrupt
+     file raises ValueError and leaves no output file.
+
+  4. The statistics of every psf are added by its worker as soon as it
+     is written, while it is still in the page cache, and are saved to
+     phosim_output_unzipped/psf_index.json (see psf_index.py).
 
 """
 
 
 # Imports
+import argparse
+import concurrent.futures
 import gzip
 import glob
 import os
 import time
 import shutil
-
-def unzip_psf():
-    '''Unzip the input psfs.'''
+from filter_utils import get_filter_id
+from psf_index import PsfIndex
+
+# Global Variables
+psf_name = r'lsst_e_99999999_f{:d}_R22_S11_E000.fits.gz'
+
+chunk_size = 2880 * 512  # bytes, a multiple of the fits block size
+
+
+class FitsChecker(object):
+    """Check the fits structure of a file fed in chunks.
+
+    :Usage:
+      checker = FitsChecker()
+
+      checker.feed(chunk)   # for each chunk
+
+      nhdu = checker.close()
+    """
+    block = 2880
+
+    def __init__(self):
+        self.buf = b''
+        self.skip = 0
+        self.cards = None
+        self.nhdu = 0
+
+    def read_block(self, block):
+        """Read one header block, return True at the END card."""
+        for i in range(0, self.block, 80):
+            card = block[i:i + 80].decode('ascii', errors='replace')
+            key = card[:8].strip()
+            if self.cards is None:
+                first = 'SIMPLE' if self.nhdu == 0 else 'XTENSION'
+                if key != first:
+                    raise ValueError('hdu %d does not start with %s' % (self.nhdu, first))
+                self.cards = {}
+            if key == 'END':
+                return True
+            if card[8:10] == '= ' and (key in ('BITPIX', 'NAXIS', 'PCOUNT', 'GCOUNT')
+                                       or key.startswith('NAXIS')):
+                self.cards[key] = int(card[10:].split('/')[0])
+        return False
+
+    def get_data_size(self):
+        """Bytes of the data of the current hdu padded to whole blocks."""
+        naxis = self.cards.get('NAXIS', 0)
+        size = 0
+        if naxis > 0:
+            size = 1
+            for n in range(1, naxis + 1):
+                size *= self.cards['NAXIS%d' % n]
+        size = (abs(self.cards['BITPIX']) // 8 * self.cards.get('GCOUNT', 1)
+                * (self.cards.get('PCOUNT', 0) + size))
+        return -(-size // self.block) * self.block
+
+    def feed(self, chunk):
+        chunk = memoryview(chunk)
+        while len(chunk):
+            if self.skip:
+                n = min(self.skip, len(chunk))
+                self.skip -= n
+                chunk = chunk[n:]
+                continue
+            need = self.block - len(self.buf)
+            self.buf += bytes(chunk[:need])
+            chunk = chunk[need:]
+            if len(self.buf) < self.block:
+                return
+            block, self.buf = self.buf, b''
+            if self.read_block(block):
+                self.skip = self.get_data_size()
+                self.cards = None
+                self.nhdu += 1
+
+    def close(self):
+        """Check that the file ended after a whole hdu.
+
+        :Returns: number of hdus.
+        """
+        if self.nhdu == 0 or self.skip or self.buf or self.cards is not None:
+            raise ValueError('truncated fits file')
+        return self.nhdu
+
+
+def unzip_file(infile, outfile, chunk_size=chunk_size, index=None):
+    """Decompress one fits.gz file in chunks, checking its fits structure.
+
+    The output is written to a temporary file and renamed when complete.
+    If index (psf_index.PsfIndex) is given the output is added to it.
+
+    :Returns: (outfile, bytes written, number of hdus)
+    """
+    tmpfile = outfile + '.tmp'
+    checker = FitsChecker()
+    nbytes = 0
+    try:
+        with gzip.open(infile, 'rb') as inzip, open(tmpfile, 'wb') as f:
+            while True:
+                chunk = inzip.read(chunk_size)
+                if not chunk:
+                    break
+                checker.feed(chunk)
+                f.write(chunk)
+                nbytes += len(chunk)
+        nhdu = checker.close()
+    except (OSError, EOFError, ValueError) as e:
+        if os.path.exists(tmpfile):
+            os.remove(tmpfile)
+        raise ValueError('%s: %s' % (infile, e))
+    os.replace(tmpfile, outfile)
+    if index is not None:
+        index.add(outfile)
+    return outfile, nbytes, nhdu
+
+
+def unzip_files(pairs, nworkers=None, chunk_size=chunk_size, index=None):
+    """Decompress many (infile, outfile) pairs at the same time.
+
+    :Returns: list of results of unzip_file in the order of pairs.
+    """
+    nworkers = nworkers or min(32, (os.cpu_count() or 1) + 4)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nworkers) as pool:
+        futures = [pool.submit(unzip_file, infile, outfile, chunk_size, index)
+                   for infile, outfile in pairs]
+        for future in concurrent.futures.as_completed(futures):
+            outfile, nbytes, nhdu = future.result()
+            print('{} {} {}'.format('outfile: ', outfile,
+                                    '({:d} bytes, {:d} hdu)'.format(nbytes, nhdu)))
+        return [future.result() for future in futures]
+
+
+def unzip_psf(filter_id=2, nbands=21, nworkers=None, chunk_size=chunk_size):
+    '''Unzip the input psfs.
+
+    filter_id is the lsst filter number or name used in the catalogs.
+    nworkers files are decompressed at the same time.
+    '''
 
     print('{} {} {}'.format('\nRunning a5_unzip_all_psf','', ''))
 
@@ -37,41 +191,18 @@ def unzip_psf():
 
     os.makedirs(outdir)
 
-    # Loop through psfs
-    for i in range(21):
-
-        # Input/output info
+    # Input/output of all narrowbands and the broadband
+    name = psf_name.format(get_filter_id(filter_id))
+    pairs = []
+    for i in range(nbands):
         indir = 'phosim_output_zipped' + r'/' + 'narrowband{:d}_out'.format(i)
-        infile = indir + r'/' + r'lsst_e_99999999_f2_R22_S11_E000.fits.gz'
-        outfile = outdir + r'/' + 'psf{:d}.fits'.format(i)
-        print('{} {:d} {}'.format('\ncount  : ', i, ''))
-        print('{} {} {}'.format('infile : ',infile, ''))
-        print('{} {} {}'.format('outfile: ',outfile, ''))
-
-        # Read zipdata
-        with gzip.open(infile, 'rb') as inzip:
-            zipdata = inzip.read()
-
-        # Write zipdata to files
-        with open(outfile, 'wb') as f:
-            f.write(zipdata)
-
-    # Also, unzip broadband
-    # Input/output info
+        pairs.append((indir + r'/' + name, outdir + r'/' + 'psf{:d}.fits'.format(i)))
     indir = 'phosim_output_zipped' + r'/' + 'broadband_out'
-    infile = indir + r'/' + r'lsst_e_99999999_f2_R22_S11_E000.fits.gz'
-    outfile = outdir + r'/' + 'broadband.fits'
-    print('{} {} {}'.format('infile : ',infile, ''))
-    print('{} {} {}'.format('outfile: ',outfile, ''))
-
-    # Read zipdata
-    with gzip.open(infile, 'rb') as inzip:
-        zipdata = inzip.read()
-
-    # Write zipdata to files
-    with open(outfile, 'wb') as f:
-        f.write(zipdata)
+    pairs.append((indir + r'/' + name, outdir + r'/' + 'broadband.fits'))
 
+    index = PsfIndex(outdir)
+    unzip_files(pairs, nworkers, chunk_size, index)
+    index.save()
 
     print('{} {} {}'.format('\nEnd of a5_unzip_all_psf','', ''))
 
@@ -82,8 +213,17 @@ if __name__ == '__main__':
     program_begin_time = time.time()
     begin_ctime        = time.ctime()
 
+    parser = argparse.ArgumentParser(description='Unzip phosim electron images.')
+    parser.add_argument('-f', '--filter', default='2',
+                        help='lsst filter number or name')
+    parser.add_argument('--nbands', type=int, default=21)
+    parser.add_argument('-n', '--nworkers', type=int, default=None,
+                        help='files decompressed at the same time')
+    args = parser.parse_args()
+    filter_id = int(args.filter) if args.filter.isdigit() else args.filter
+
     # run main
-    unzip_psf()
+    unzip_psf(filter_id, args.nbands, args.nworkers)
 
 
 
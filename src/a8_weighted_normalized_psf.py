@@ -18,6 +18,19 @@
  2. The weight range 1 to 1.2 are the average flux ratio of 100 f606 and f814
     galaxies. (refer: ~/phosim/simdatabase/average_flux_ratio.py)
 
+ 3. The weights can also be given in a text file (``-w weights.txt``),
+    one weight per line in the order of the files, or lines of
+    ``filename weight`` for any list of files.
+
+ 4. The inputs are read tile by tile (blocks of rows) through memory
+    maps and added in place into a float64 tile, the output is written
+    tile by tile. The tile size is set by the memory budget
+    (``-m`` megabytes), so hundreds of full chip psfs can be stacked
+    with little memory.
+
+ 5. The statistics of the output are added to psf_index.json of its
+    folder (see psf_index.py).
+
 :Runtime: 
   3 sec
   
@@ -27,44 +40,136 @@
 # Imports
 from astropy.io import fits
 import numpy as np
+import argparse
+import os
 import time
-
-
-
-def weighted_psf(indir):
+from psf_index import PsfIndex
+
+# Global Variables
+mem_budget = 256 * 1024**2  # bytes of memory for the tiles
+
+
+
+def read_weights(weightfile, indir=None):
+    '''Read weights from a text file.
+
+    Lines are either ``weight`` or ``filename weight``, # starts a comment.
+    Filenames are relative to indir if given.
+
+    :Returns: (list of files or None, list of weights)
+    '''
+    infiles, weights = [], []
+    with open(weightfile, 'r') as f:
+        for line in f:
+            row = line.split('#')[0].split()
+            if not row:
+                continue
+            weights.append(float(row[-1]))
+            if len(row) > 1:
+                infiles.append(os.path.join(indir, row[0]) if indir else row[0])
+    if infiles and len(infiles) != len(weights):
+        raise ValueError('%s: give a filename on every line or on none' % weightfile)
+    return infiles or None, weights
+
+
+def get_layout(infile):
+    '''Get data offset, dtype, shape, bscale and bzero of the primary hdu.'''
+    with fits.open(infile, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = hdul[0]
+        dtype = hdu.data.dtype
+        return (hdu.fileinfo()['datLoc'], dtype, hdu.data.shape,
+                hdu.header.get('BSCALE', 1.0), hdu.header.get('BZERO', 0.0))
+
+
+def read_tile(infile, layout, r0, r1):
+    '''Memory map rows r0 to r1 of the image of a fitsfile.
+
+    The values are not scaled, the pixel value is tile * bscale + bzero.
+    '''
+    offset, dtype, shape, bscale, bzero = layout
+    nx = shape[1]
+    return np.memmap(infile, dtype=dtype, mode='r',
+                     offset=offset + r0 * nx * dtype.itemsize, shape=(r1 - r0, nx))
+
+
+def stack_psfs(infiles, weights, outfile='weighted_psf.fits',
+               mem_budget=mem_budget, dtype='float64'):
+    '''Write the weighted average of fitsfiles, tile by tile.
+
+    :Usage: stack_psfs(infiles, weights, 'weighted_psf.fits', 64 * 1024**2)
+
+    mem_budget is the memory in bytes for the float64 sum, the float64
+    scratch tile and the output tile. Scaled inputs (BSCALE, BZERO) are
+    scaled in the scratch tile, so they need no more memory.
+    '''
+    if len(infiles) != len(weights):
+        raise ValueError('%d files but %d weights' % (len(infiles), len(weights)))
+    layouts = [get_layout(infile) for infile in infiles]
+    shape = layouts[0][2]
+    for infile, layout in zip(infiles, layouts):
+        if layout[2] != shape:
+            raise ValueError('%s has shape %s, not %s' % (infile, layout[2], shape))
+
+    ny, nx = shape
+    dtype = np.dtype(dtype)
+    rows = max(1, min(ny, int(mem_budget // (nx * (16 + dtype.itemsize)))))
+    total = np.zeros((rows, nx), dtype='float64')
+    scratch = np.empty((rows, nx), dtype='float64')
+    wsum = float(np.sum(weights, dtype='float64'))
+    print('{} {} {}'.format('Stacking', len(infiles),
+                            'files of {}x{} in tiles of {:d} rows'.format(ny, nx, rows)))
+
+    header = fits.PrimaryHDU(np.zeros((1, 1), dtype=dtype)).header
+    header['NAXIS1'] = nx
+    header['NAXIS2'] = ny
+    header['NSTACK'] = (len(infiles), 'number of stacked psfs')
+    header['WEIGHTS'] = (wsum, 'sum of the weights')
+    # a StreamingHDU appends to an existing file, so write a new one
+    tmpfile = '{}.{:d}.tmp'.format(outfile, os.getpid())
+    if os.path.exists(tmpfile):
+        os.remove(tmpfile)
+    out = fits.StreamingHDU(tmpfile, header)
+    try:
+        for r0 in range(0, ny, rows):
+            r1 = min(r0 + rows, ny)
+            acc, tmp = total[:r1 - r0], scratch[:r1 - r0]
+            acc.fill(0.0)
+            for infile, layout, weight in zip(infiles, layouts, weights):
+                tile = read_tile(infile, layout, r0, r1)
+                # weight * (tile * bscale + bzero) in the scratch tile
+                bscale, bzero = layout[3], layout[4]
+                np.multiply(tile, weight * bscale, out=tmp)
+                if bzero != 0.0:
+                    tmp += weight * bzero
+                acc += tmp
+                del tile
+            acc /= wsum
+            out.write(acc.astype(dtype))
+    finally:
+        out.close()
+    os.replace(tmpfile, outfile)
+    return outfile
+
+
+def weighted_psf(indir, weights=None, infiles=None, outfile='weighted_psf.fits',
+                 mem_budget=mem_budget, dtype='float64'):
     '''This program creates the weighted psf. '''
 
     # weights
     # range 1 to 1.2 are the average flux ratio of 100 f606 and f814 galaxies
     # (refer: ~/phosim/simdatabase/average_flux_ratio.py)
-    nfiles = 21
-    weight = np.linspace(1.0,1.2,num=nfiles,endpoint=True)
-    
-    # read data from first input file
-    dat = fits.getdata(indir+'/psf0.fits')
-    
-    # make data all zero
-    dat = dat * 0.0
-    
-    # average the data
-    for i in range(0,nfiles):
-        infile = indir + '/psf{:d}.fits'.format(i)
-        tmp    = fits.getdata(infile) * weight[i]
-            
-        # add data
-        dat += tmp    
-        
-        if i ==(nfiles-1):
-            dat = dat/sum(weight)
-    
-    # create HDU objects to write fitsfiles
-    hdu      = fits.PrimaryHDU()
-    hdu.data = dat
-    
-    
-    # write to a fitsfile
-    outfile = 'weighted_psf.fits'
-    hdu.writeto(outfile, clobber=True)
+    nfiles = len(infiles) if infiles else len(weights) if weights is not None else 21
+    if weights is None:
+        weights = np.linspace(1.0,1.2,num=nfiles,endpoint=True)
+    if infiles is None:
+        infiles = [indir + '/psf{:d}.fits'.format(i) for i in range(nfiles)]
+
+    stack_psfs(infiles, weights, outfile, mem_budget, dtype)
+
+    # add to the psf index of the output folder
+    index = PsfIndex(os.path.dirname(outfile) or '.')
+    index.add(outfile)
+    index.save()
     
     # output info
     print('{} {} {}'.format('\nCreating file: ',outfile, ''))
@@ -77,8 +182,23 @@ if __name__ == '__main__':
     # beginning time
     begin_time,begin_ctime = time.time(), time.ctime()
 
+    parser = argparse.ArgumentParser(description='Weighted average of psfs.')
+    parser.add_argument('-i', '--indir', default='phosim_normalized_psf')
+    parser.add_argument('-w', '--weights', default=None,
+                        help='text file of weights, or of filename weight')
+    parser.add_argument('-o', '--outfile', default='weighted_psf.fits')
+    parser.add_argument('-m', '--mem-mb', type=float, default=mem_budget / 1024**2,
+                        help='memory budget of the tiles in megabytes')
+    parser.add_argument('--dtype', default='float64', choices=['float32', 'float64'])
+    args = parser.parse_args()
+
+    infiles, weights = None, None
+    if args.weights:
+        infiles, weights = read_weights(args.weights, args.indir)
+
     # run main program
-    weighted_psf('phosim_normalized_psf')
+    weighted_psf(args.indir, weights, infiles, args.outfile,
+                 int(args.mem_mb * 1024**2), args.dtype)
 
     # print the time taken
     end_time,end_ctime  = time.time(), time.ctime()
@@ -7,7 +7,8 @@
 """ This program plots the given input sed file. 
 
 :Inputs: 
-  a sed file (zipped or non_zipped)
+  a sed file, plain or gzip compressed (.gz), parsed once through
+  sed_utils.load_sed
   
   e.g.  original_seds/sed_flat.txt
   
@@ -22,29 +23,37 @@
 
 # Imports
 import numpy as np
-import pandas as pd
 import matplotlib.pyplot as plt
+from sed_utils import load_sed, SED
 
-def plot_sed():
-    """ Plot the sed file. """
-    # input/output
-    #infile = 'sed_flat.txt'
-    infile = 'original_seds/exp9_pf.cat'
-    outimage = infile[0:-4] + '_6gyr'+ '.png'
-    
-    # read in a file
-    infile = infile
-    colnames = ['c0', 'c1']
-    print('{} {} {} {}'.format('\nreading file : ', infile, '','' ))
-    df = pd.read_csv(infile,sep='\s+', header = None,skiprows = 0,
-                     comment='#',names=colnames,usecols=(0,5))
+def plot_sed(sed=None, outimage=None, show=True):
+    """ Plot the sed file.
+
+    :Usage: plot_sed(sed) plots a sed_utils.SED object from a0 or a2
+        without reading any file.
+    """
+    if sed is None:
+        # input/output
+        #infile = 'sed_flat.txt'
+        infile = 'original_seds/exp9_pf.cat'
+        outimage = infile[0:-4] + '_6gyr'+ '.png'
+        
+        # read in a file
+        infile = infile
+        print('{} {} {} {}'.format('\nreading file : ', infile, '','' ))
+        header, table = load_sed(infile)
+        sed = SED(table[:, 0], table[:, 5], header, infile)
+
+    if outimage is None:
+        outimage = sed.name[0:-4] + '.png'
+    wave, flux = sed.wave, sed.flux
     
-    print(df.head())
+    print(np.column_stack((wave[:5], flux[:5])))
     print("\n")
     
     
     ## plot wave vs trans
-    plt.plot(df.c0,df.c1,linewidth=1,color='b')
+    plt.plot(wave,flux,linewidth=1,color='b')
     
     # title and axes labels
     plt.title(outimage)
@@ -67,7 +76,8 @@ def plot_sed():
     outimage = outimage
     print('{} {}'.format('\noutput image = ',outimage ))
     plt.savefig(outimage)
-    plt.show()
+    if show:
+        plt.show()
 
 if __name__ == '__main__':
     plot_sed()
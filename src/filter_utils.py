@@ -0,0 +1,152 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Jul 28, 2017 Fri
+# Last update :
+"""Read the LSST filter curves of phosim and derive passband edges.
+
+:Depends:
+    ~/phosim/data/lsst/filter_0.txt ... filter_5.txt
+
+:Outputs:
+    filter_index.json
+
+:Info:
+
+  1. The lsst filters u, g, r, i, z, y are filter_0.txt ... filter_5.txt
+     in the phosim data directory, the same number used by Opsim_filter
+     in the instance catalogs.
+
+  2. The passband of a filter is the wavelength range where transmission
+     is more than a threshold, e.g. 5% gives 531 nm - 696 nm for r band.
+
+  3. The passband edges are saved in filter_index.json keyed on the
+     filter file, its size and mtime and the threshold, so later lookups
+     do not read the filter files.
+
+"""
+
+# Imports
+import json
+import os
+import numpy as np
+
+# Global Variables
+datadir = os.path.expanduser('~/phosim/data/lsst')
+index_file = 'filter_index.json'
+filters = ['u', 'g', 'r', 'i', 'z', 'y']
+
+
+def get_filter_id(name):
+    """Get phosim filter number from a name, e.g. 'r' or '2' gives 2."""
+    if str(name) in filters:
+        return filters.index(str(name))
+    filter_id = int(name)
+    if not 0 <= filter_id < len(filters):
+        raise ValueError('Unknown lsst filter: %s' % name)
+    return filter_id
+
+
+def get_filter_file(name, datadir=None):
+    """Get the phosim filter file for a filter name or number.
+
+    If name is already an existing file it is returned unchanged. The
+    default datadir is the module variable datadir.
+    """
+    if os.path.isfile(str(name)):
+        return str(name)
+    if datadir is None:
+        datadir = globals()['datadir']
+    return os.path.join(datadir, 'filter_{:d}.txt'.format(get_filter_id(name)))
+
+
+def read_filter(filterfile):
+    """Read a phosim filter file.
+
+    :Usage: wave, trans = read_filter('phosim/data/lsst/filter_2.txt')
+
+    The filter file has two columns: wavelength (nm) and transmission.
+    The wavelength is returned in Angstrom to match the sed files.
+    """
+    wave, trans = np.loadtxt(filterfile, comments='#', usecols=(0, 1),
+                             unpack=True, dtype='float')
+    return wave * 10.0, trans
+
+
+def load_filters(datadir=None):
+    """Load all lsst filter curves.
+
+    :Returns: dictionary filter name -> (wave, trans)
+    """
+    return {name: read_filter(get_filter_file(name, datadir))
+            for name in filters}
+
+
+def derive_passband(wave, trans, threshold=0.05):
+    """Get the wavelength range (Angstrom) where transmission > threshold."""
+    inband = wave[trans > threshold]
+    if len(inband) == 0:
+        raise ValueError('No transmission above %g' % threshold)
+    return int(np.ceil(inband[0])), int(np.floor(inband[-1]))
+
+
+def read_index(index_file=index_file):
+    """Read the passband index, empty if it does not exist."""
+    if not os.path.exists(index_file):
+        return {}
+    try:
+        with open(index_file, 'r') as f:
+            return json.load(f)
+    except ValueError:
+        return {}
+
+
+def write_index(index, index_file=index_file):
+    """Write the passband index atomically."""
+    tmpfile = '{}.{:d}.tmp'.format(index_file, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(index, f, indent=1, sort_keys=True)
+    os.replace(tmpfile, index_file)
+
+
+def get_passband(filterfile, threshold=0.05, index_file=index_file):
+    """Get passband edges of a filter, cached in the index file.
+
+    :Example:
+      get_passband('phosim/data/lsst/filter_2.txt', 0.05) gives (5310, 6960)
+
+    filterfile may also be a filter name, e.g. 'r'.
+    Use index_file=None to skip the cache.
+    """
+    filterfile = get_filter_file(filterfile)
+    stat = os.stat(filterfile)
+    key = '{}:{:g}'.format(os.path.abspath(filterfile), threshold)
+    index = read_index(index_file) if index_file else {}
+
+    entry = index.get(key)
+    if entry and entry['size'] == stat.st_size and \
+       entry['mtime_ns'] == stat.st_mtime_ns:
+        lambda_start, lambda_end = entry['passband']
+    else:
+        lambda_start, lambda_end = derive_passband(*read_filter(filterfile),
+                                                   threshold=threshold)
+        if index_file:
+            index[key] = {'size': stat.st_size,
+                          'mtime_ns': stat.st_mtime_ns,
+                          'passband': [lambda_start, lambda_end]}
+            write_index(index, index_file)
+
+    print('{} {} {}'.format('passband (Angstrom)  : ', (lambda_start, lambda_end),
+                            'from ' + filterfile))
+    return lambda_start, lambda_end
+
+
+def get_all_passbands(threshold=0.05, datadir=None, index_file=index_file):
+    """Get passband edges of all lsst filters.
+
+    :Returns: dictionary filter name -> (lambda_start, lambda_end)
+    """
+    return {name: get_passband(get_filter_file(name, datadir), threshold,
+                               index_file)
+            for name in filters}
@@ -0,0 +1,220 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 04, 2017 Fri
+# Last update :
+"""Asyncio driver for phosim runs, used by a4_run_phosim_all_catalogs --async.
+
+:Info:
+
+  1. Phosim is started without a shell in its own process group, its
+     pipes are read by the event loop and it is waited for with os.wait4
+     on a thread, so the ledger gets its cpu time, peak memory and bytes
+     written as with a4.run_job.
+
+  2. The stdout and stderr of each run are streamed line by line into the
+     run logfile, every line is prefixed with the time and out or err.
+     With echo=True the lines are also printed with the catalog name.
+
+  3. A run longer than timeout seconds is stopped: SIGTERM is sent to its
+     process group and SIGKILL after a grace time.
+
+  4. Ctrl-C (SIGINT) or SIGTERM to the controller cancels all the runs and
+     stops all their processes the same way.
+
+  5. One controller process can supervise many runs at the same time, the
+     number of runs at once is limited by nslots.
+
+"""
+
+# Imports
+import asyncio
+import concurrent.futures
+import os
+import shutil
+import signal
+import subprocess
+import time
+import phosim_cache
+import phosim_ledger
+from phosim_jobs import get_phosim_command, get_result
+
+# Global Variables
+grace_time = 10.0  # seconds between SIGTERM and SIGKILL
+
+
+async def stream_lines(stream, tag, log, name, echo=False):
+    """Copy lines of a process stream to the log with a prefix."""
+    while True:
+        line = await stream.readline()
+        if not line:
+            break
+        text = line.decode(errors='replace').rstrip('\n')
+        log.write('[{} {}] {}\n'.format(time.strftime('%H:%M:%S'), tag, text))
+        log.flush()
+        if echo:
+            print('{} | {}'.format(name, text))
+
+
+async def open_stream(pipe):
+    """Get an asyncio StreamReader reading a pipe of a subprocess.Popen."""
+    loop = asyncio.get_running_loop()
+    reader = asyncio.StreamReader()
+    await loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader),
+                                 pipe)
+    return reader
+
+
+async def stop_process(proc, waiter, grace=grace_time):
+    """Stop a process group, SIGTERM first, then SIGKILL after grace seconds.
+
+    waiter is the future of os.wait4 of the process.
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        if waiter.done():
+            return
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), grace)
+            return
+        except asyncio.TimeoutError:
+            pass
+
+
+async def run_job_async(job, phosim_dir, phosim_exe, timeout=None,
+                        cache_dir=None, echo=False, executor=None):
+    """Run phosim for one job with asyncio.
+
+    The process is waited for with os.wait4 on a thread of executor, which
+    needs one thread for every run at the same time.
+
+    :Returns: same dictionary as a4.run_job, with timeout True if the run
+        was stopped after timeout seconds.
+    """
+    begin_time = time.time()
+    result = {'name': job['name'], 'logfile': job['logfile'],
+              'cached': False, 'timeout': False}
+
+    if cache_dir:
+        key = phosim_cache.get_run_key(job, phosim_dir, phosim_exe)
+        if phosim_cache.fetch(key, job['outdir'], cache_dir):
+            result.update(returncode=0, cached=True,
+                          seconds=time.time() - begin_time)
+            return result
+
+    if not os.path.exists(job['workdir']):
+        os.makedirs(job['workdir'])
+
+    loop = asyncio.get_running_loop()
+    commands = get_phosim_command(job, phosim_exe)
+    with open(job['logfile'], 'w') as log:
+        log.write(' '.join(commands) + '\n')
+        log.flush()
+        try:
+            proc = subprocess.Popen(commands, cwd=phosim_dir,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    start_new_session=True)
+        except OSError as e:
+            log.write('Could not run phosim: %s\n' % e)
+            result.update(returncode=-1, seconds=time.time() - begin_time)
+            return result
+
+        # the rusage of the run and its children, the process is reaped here
+        waiter = loop.run_in_executor(executor, os.wait4, proc.pid, 0)
+        readers = asyncio.gather(
+            stream_lines(await open_stream(proc.stdout), 'out', log,
+                         job['name'], echo),
+            stream_lines(await open_stream(proc.stderr), 'err', log,
+                         job['name'], echo))
+        try:
+            await asyncio.wait_for(asyncio.gather(readers, asyncio.shield(waiter)),
+                                   timeout)
+        except asyncio.TimeoutError:
+            log.write('Timeout after {} seconds, stopping phosim\n'.format(timeout))
+            result['timeout'] = True
+            await stop_process(proc, waiter)
+        except asyncio.CancelledError:
+            log.write('Cancelled, stopping phosim\n')
+            await stop_process(proc, waiter)
+            raise
+        finally:
+            readers.cancel()
+
+    rusage = None
+    returncode = -1
+    if waiter.done():
+        pid, status, rusage = waiter.result()
+        returncode = proc.returncode = os.waitstatus_to_exitcode(status)
+    if returncode == 0 and not result['timeout']:
+        shutil.rmtree(job['workdir'], ignore_errors=True)
+        if cache_dir:
+            phosim_cache.store(key, job['outdir'], job['name'], cache_dir)
+
+    result.update(get_result(job, returncode, time.time() - begin_time, rusage))
+    print('{} {} {}'.format(' End running Phosim for catalog :', job['name'],
+                            'exit code {:d}, {:.1f} sec'.format(returncode,
+                                                               result['seconds'])))
+    return result
+
+
+async def run_jobs_async(jobs, nslots, phosim_dir, phosim_exe, timeout=None,
+                         cache_dir=None, journal=None, ledger_file=None,
+                         echo=False):
+    """Run many phosim jobs, nslots at a time, in one event loop.
+
+    SIGINT and SIGTERM cancel all runs and stop their processes.
+    """
+    loop = asyncio.get_running_loop()
+    main_task = asyncio.current_task()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, main_task.cancel)
+
+    slots = asyncio.Semaphore(nslots)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=nslots)
+
+    async def run_one(job):
+        async with slots:
+            print('{} {} {}'.format(' Begin running Phosim for catalog :', job['name'], ''))
+            if journal is not None:
+                journal.mark_running(job)
+            result = await run_job_async(job, phosim_dir, phosim_exe, timeout,
+                                         cache_dir, echo, executor)
+            if journal is not None:
+                if result['returncode'] == 0 and not result['timeout']:
+                    journal.mark_done(job)
+                else:
+                    journal.mark_failed(job, result['returncode'])
+            if ledger_file:
+                phosim_ledger.append_record(phosim_ledger.get_record(job, result),
+                                            ledger_file)
+            return result
+
+    tasks = [asyncio.ensure_future(run_one(job)) for job in jobs]
+    try:
+        return await asyncio.gather(*tasks)
+    except asyncio.CancelledError:
+        print('\nCancelled, stopping all phosim runs ...')
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        raise
+    finally:
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.remove_signal_handler(sig)
+        executor.shutdown(wait=False)
+
+
+def run_jobs(jobs, nslots, phosim_dir, phosim_exe, timeout=None,
+             cache_dir=None, journal=None, ledger_file=None, echo=False):
+    """Run phosim jobs with asyncio, blocking until all are finished.
+
+    :Usage: results = run_jobs(jobs, 8, phosim_dir, './phosim', timeout=3600)
+    """
+    return asyncio.run(run_jobs_async(jobs, nslots, phosim_dir, phosim_exe,
+                                      timeout, cache_dir, journal,
+                                      ledger_file, echo))
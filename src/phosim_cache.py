@@ -0,0 +1,170 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 01, 2017 Tue
+# Last update :
+"""Content addressed cache of phosim outputs used by a4_run_phosim_all_catalogs.
+
+:Outputs:
+    phosim_cache/key/*.fits.gz
+
+    phosim_cache/key/manifest.json
+
+:Info:
+
+  1. The key of a phosim run is the sha1 of everything that changes the
+     output: the instance catalog, the content of every sed it refers to,
+     the background (command) file, the phosim version and the phosim
+     executable name.
+
+  2. After a successful run the output files are hard linked into
+     phosim_cache/key. When a later run has the same key the cached files
+     are linked into its output folder and phosim is not run.
+
+  3. Hard links cost no disk space, files are copied only if the cache is
+     on another file system.
+
+"""
+
+# Imports
+import hashlib
+import json
+import os
+import shutil
+import time
+
+# Global Variables
+cache_dir = 'phosim_cache'
+manifest_name = 'manifest.json'
+
+
+def hash_file(infile, sha=None, chunk_size=1 << 20):
+    """Update sha (or a new sha1) with the content of a file."""
+    sha = sha or hashlib.sha1()
+    with open(infile, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha
+
+
+def get_sed_files(catalog, phosim_dir):
+    """Get the sed files used by the objects of an instance catalog.
+
+    Sed paths in the catalogs are relative to phosim/data/SEDs/
+    """
+    seds = []
+    with open(catalog, 'r') as f:
+        for line in f:
+            row = line.split()
+            if len(row) > 5 and row[0] == 'object':
+                seds.append(os.path.normpath(os.path.join(phosim_dir, 'data',
+                                                          'SEDs', row[5])))
+    return seds
+
+
+def get_phosim_version(phosim_dir, phosim_exe):
+    """Get phosim version from phosim_dir/version, or hash of the executable."""
+    version_file = os.path.join(phosim_dir, 'version')
+    if os.path.exists(version_file):
+        with open(version_file, 'r') as f:
+            return f.read().strip()
+    exe = os.path.join(phosim_dir, phosim_exe)
+    if os.path.exists(exe):
+        return 'exe:' + hash_file(exe).hexdigest()
+    return 'unknown'
+
+
+def get_run_key(job, phosim_dir, phosim_exe):
+    """Get the cache key of a phosim job.
+
+    :Usage: key = get_run_key(job, phosim_dir, './phosim')
+    """
+    sha = hashlib.sha1()
+    for name, infile in [('catalog', job['catalog']),
+                         ('background', job['background'])]:
+        sha.update(name.encode())
+        hash_file(infile, sha)
+
+    for sed in get_sed_files(job['catalog'], phosim_dir):
+        sha.update(b'sed')
+        if os.path.exists(sed):
+            hash_file(sed, sha)
+        else:
+            sha.update(('missing:' + sed).encode())
+
+    sha.update(b'version')
+    sha.update(get_phosim_version(phosim_dir, phosim_exe).encode())
+    sha.update(b'exe')
+    sha.update(os.path.basename(phosim_exe).encode())
+    return sha.hexdigest()
+
+
+def link_file(src, dst):
+    """Hard link src to dst, copy if linking is not possible."""
+    if os.path.exists(dst):
+        os.remove(dst)
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+
+
+def is_cached(key, cache_dir=cache_dir):
+    """True if the outputs of key are in the cache."""
+    return os.path.exists(os.path.join(cache_dir, key, manifest_name))
+
+
+def fetch(key, outdir, cache_dir=cache_dir):
+    """Link cached outputs of key into outdir.
+
+    :Returns: list of linked files, or None if key is not in the cache.
+    """
+    entry = os.path.join(cache_dir, key)
+    manifest = os.path.join(entry, manifest_name)
+    if not is_cached(key, cache_dir):
+        return None
+
+    with open(manifest, 'r') as f:
+        meta = json.load(f)
+
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    outfiles = []
+    for name in meta['files']:
+        outfile = os.path.join(outdir, name)
+        link_file(os.path.join(entry, name), outfile)
+        outfiles.append(outfile)
+    return outfiles
+
+
+def store(key, outdir, job_name='', cache_dir=cache_dir, suffix='.fits.gz'):
+    """Put the phosim outputs of outdir in the cache under key.
+
+    Only files ending with suffix are stored, not logs or work files.
+    The entry is written in a temporary folder and renamed into place, so
+    an interrupted store never leaves a half entry.
+    """
+    entry = os.path.join(cache_dir, key)
+    if os.path.exists(os.path.join(entry, manifest_name)):
+        return entry
+
+    names = sorted(name for name in os.listdir(outdir) if name.endswith(suffix))
+    tmpdir = '{}.{:d}.tmp'.format(entry, os.getpid())
+    if os.path.exists(tmpdir):
+        shutil.rmtree(tmpdir)
+    os.makedirs(tmpdir)
+    for name in names:
+        link_file(os.path.join(outdir, name), os.path.join(tmpdir, name))
+
+    meta = {'key': key, 'job': job_name, 'files': names,
+            'created': time.ctime()}
+    with open(os.path.join(tmpdir, manifest_name), 'w') as f:
+        json.dump(meta, f, indent=1)
+
+    try:
+        os.rename(tmpdir, entry)
+    except OSError:
+        # another run stored the same key first
+        shutil.rmtree(tmpdir, ignore_errors=True)
+    return entry
@@ -0,0 +1,113 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 04, 2017 Fri
+# Last update :
+"""Phosim jobs and commands shared by a4_run_phosim_all_catalogs and phosim_async.
+
+:Info:
+
+  1. A job is a dictionary with the name, catalog, background, outdir,
+     workdir and logfile of one phosim run, see get_job.
+
+  2. a4_run_phosim_all_catalogs imports everything from here, so
+     a4.get_job, a4.scripts_dir etc. keep working for the other scripts.
+
+:Usage:
+    jobs = get_jobs(21, scripts_dir)
+
+    commands = get_phosim_command(jobs[0], './phosim')
+
+"""
+
+# Imports
+import os
+import shutil
+import subprocess
+import phosim_ledger
+
+# Global Variables
+scripts_dir = '/Users/poudel/Research/psf_creation_phosim/scripts/'
+phosim_dir = os.path.expanduser('~/phosim')
+phosim_exe = './phosim'
+output = 'phosim_output_zipped'
+
+
+def replace_outdir(outdir):
+    """Replace a folder."""
+    if os.path.exists(outdir):
+        print('Replacing folder: %s\n'%outdir)
+        shutil.rmtree(outdir)
+        os.makedirs(outdir)
+    else:
+        print('Making new folder: %s\n'%outdir)
+        os.makedirs(outdir)
+
+
+def get_job(name, scripts_dir=scripts_dir, output=output):
+    """Get the description of one phosim run.
+
+    :Usage: get_job('narrowband0')
+
+    :Returns: dictionary with name, catalog, background, outdir, workdir and
+        logfile. All paths are absolute since phosim runs from phosim_dir.
+    """
+    outdir = os.path.join(scripts_dir, output, name + '_out')
+    return {'name'      : name,
+            'catalog'   : os.path.join(scripts_dir, 'instance_catalogs',
+                                       name + '.icat'),
+            'background': os.path.join(scripts_dir, 'backgrounds',
+                                       'background1.bkg'),
+            'outdir'    : outdir,
+            'workdir'   : os.path.join(outdir, 'work'),
+            'logfile'   : os.path.join(outdir, name + '.log')}
+
+
+def get_jobs(nbands=21, scripts_dir=scripts_dir, output=output):
+    """Get jobs for all narrowband catalogs and the broadband catalog."""
+    names = ['narrowband{:d}'.format(i) for i in range(nbands)] + ['broadband']
+    return [get_job(name, scripts_dir, output) for name in names]
+
+
+def get_phosim_command(job, phosim_exe=phosim_exe):
+    """Get phosim command as a list of arguments, run from phosim_dir."""
+    return [phosim_exe, job['catalog'],
+            '-c', job['background'],
+            '-o', job['outdir'],
+            '-w', job['workdir']]
+
+
+def call_with_rusage(commands, on_start=None, **kwargs):
+    """Run a command and get its exit code and resource usage.
+
+    The resource usage from os.wait4 includes all the children of the
+    command that it waited for, i.e. the phosim subprograms. If on_start
+    is given it is called with the Popen as soon as the command started.
+
+    :Returns: (returncode, rusage)
+    """
+    proc = subprocess.Popen(commands, **kwargs)
+    if on_start is not None:
+        on_start(proc)
+    pid, status, rusage = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    return proc.returncode, rusage
+
+
+def get_result(job, returncode, seconds, rusage=None):
+    """Get the result of a phosim run that was not taken from the cache.
+
+    :Returns: dictionary with name, returncode, seconds, logfile, cached,
+        out_bytes and, if rusage (from os.wait4) is given, user_sec,
+        sys_sec, maxrss_bytes and write_blocks.
+    """
+    result = {'name': job['name'], 'returncode': returncode,
+              'seconds': seconds, 'logfile': job['logfile'], 'cached': False,
+              'out_bytes': phosim_ledger.get_folder_size(job['outdir'])}
+    if rusage is not None:
+        result.update({'user_sec'    : rusage.ru_utime,
+                       'sys_sec'     : rusage.ru_stime,
+                       'maxrss_bytes': phosim_ledger.get_maxrss_bytes(rusage),
+                       'write_blocks': rusage.ru_oublock})
+    return result
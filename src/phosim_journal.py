@@ -0,0 +1,145 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 02, 2017 Wed
+# Last update :
+"""Run journal of a phosim campaign, used by a4_run_phosim_all_catalogs --resume.
+
+:Outputs:
+    phosim_journal.json
+
+:Info:
+
+  1. Every catalog of a campaign has an entry with status pending,
+     running, done or failed, the number of attempts, the exit code and
+     the sha1 of every output file of a done run.
+
+  2. The journal is written to disk after every change, so it survives a
+     crash or a reboot.
+
+  3. On resume:
+
+     done runs whose outputs still match their checksums are skipped,
+
+     running runs were interrupted, their partial outputs are deleted
+     and they are run again,
+
+     failed runs are run again until they reach max_retries attempts.
+
+"""
+
+# Imports
+import json
+import os
+import shutil
+import threading
+import time
+from phosim_cache import hash_file
+
+# Global Variables
+journal_file = 'phosim_journal.json'
+
+
+class Journal(object):
+    """Persistent status of every phosim job of a campaign.
+
+    :Usage:
+      journal = Journal('phosim_journal.json', max_retries=3)
+
+      jobs = journal.plan_resume(jobs)
+    """
+
+    def __init__(self, path=journal_file, max_retries=3):
+        self.path = path
+        self.max_retries = max_retries
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(path):
+            with open(path, 'r') as f:
+                self.entries = json.load(f)['jobs']
+
+    def save(self):
+        """Write the journal atomically, call with the lock held."""
+        tmpfile = '{}.{:d}.tmp'.format(self.path, os.getpid())
+        with open(tmpfile, 'w') as f:
+            json.dump({'updated': time.ctime(), 'jobs': self.entries}, f,
+                      indent=1, sort_keys=True)
+        os.replace(tmpfile, self.path)
+
+    def update(self, name, **kwargs):
+        """Update the entry of one job and save the journal."""
+        with self.lock:
+            entry = self.entries.setdefault(name, {'status': 'pending',
+                                                   'attempts': 0})
+            entry.update(kwargs)
+            entry['updated'] = time.ctime()
+            self.save()
+
+    def reset(self, jobs):
+        """Start a new campaign with every job pending."""
+        with self.lock:
+            self.entries = {}
+        for job in jobs:
+            self.update(job['name'], status='pending', attempts=0)
+
+    def mark_running(self, job):
+        attempts = self.entries.get(job['name'], {}).get('attempts', 0) + 1
+        self.update(job['name'], status='running', attempts=attempts,
+                    outdir=job['outdir'])
+
+    def mark_done(self, job, suffix='.fits.gz'):
+        """Mark a job done with the checksums of its output files."""
+        outputs = {name: hash_file(os.path.join(job['outdir'], name)).hexdigest()
+                   for name in sorted(os.listdir(job['outdir']))
+                   if name.endswith(suffix)}
+        self.update(job['name'], status='done', returncode=0, outputs=outputs)
+
+    def mark_failed(self, job, returncode):
+        self.update(job['name'], status='failed', returncode=returncode)
+
+    def verify(self, job):
+        """Check that a done job still has all its outputs unchanged."""
+        entry = self.entries.get(job['name'], {})
+        if entry.get('status') != 'done' or not entry.get('outputs'):
+            return False
+        for name, sha1 in entry['outputs'].items():
+            outfile = os.path.join(job['outdir'], name)
+            if not os.path.exists(outfile) or hash_file(outfile).hexdigest() != sha1:
+                return False
+        return True
+
+    def plan_resume(self, jobs):
+        """Get the jobs that still have to run.
+
+        Partial outputs of interrupted runs are deleted.
+        """
+        todo = []
+        for job in jobs:
+            entry = self.entries.get(job['name'], {})
+            status = entry.get('status', 'pending')
+
+            if status == 'done' and self.verify(job):
+                print('{} {} {}'.format('skip done   :', job['name'], ''))
+                continue
+
+            if status == 'failed' and entry.get('attempts', 0) >= self.max_retries:
+                print('{} {} {}'.format('skip failed :', job['name'],
+                                        'after {:d} attempts'.format(entry['attempts'])))
+                continue
+
+            if status in ('running', 'done') and os.path.exists(job['outdir']):
+                print('{} {} {}'.format('discard     :', job['name'],
+                                        'partial or changed outputs'))
+                shutil.rmtree(job['outdir'])
+
+            self.update(job['name'], status='pending')
+            todo.append(job)
+        return todo
+
+    def summary(self):
+        """Count jobs in each status."""
+        counts = {}
+        for entry in self.entries.values():
+            counts[entry['status']] = counts.get(entry['status'], 0) + 1
+        return counts
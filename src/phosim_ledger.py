@@ -0,0 +1,175 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 03, 2017 Thu
+# Last update :
+"""Ledger of resources used by every phosim run of a4_run_phosim_all_catalogs.
+
+:Outputs:
+    phosim_ledger.csv
+
+:Info:
+
+  1. One row is appended for every phosim run with the band (catalog
+     name), SIM_SEED, SIM_VISTIME, magnitude and Opsim_filter of the
+     catalog.
+
+  2. The resources are wall time, user and system cpu time, peak memory
+     (maxrss) of phosim and its children, bytes of output files and
+     number of block writes, all from os.wait4.
+
+  3. The ledger is a plain csv file, e.g. pandas.read_csv('phosim_ledger.csv').
+
+  4. estimate_seconds predicts the wall time of a new run from the past
+     runs with the same band, magnitude, vistime and filter. Without such
+     runs the past times are scaled by the number of photons,
+     vistime * 10**(-0.4 magnitude), of the same band, then the same
+     filter, then all runs.
+
+"""
+
+# Imports
+import csv
+import io
+import os
+import statistics
+import sys
+import time
+
+# Global Variables
+ledger_file = 'phosim_ledger.csv'
+fields = ['date', 'name', 'seed', 'vistime', 'magnitude', 'filter',
+          'returncode', 'cached', 'wall_sec', 'user_sec', 'sys_sec',
+          'maxrss_bytes', 'out_bytes', 'write_blocks']
+
+
+def get_catalog_info(catalog):
+    """Get seed, vistime, filter and magnitude of an instance catalog.
+
+    :Returns: dictionary, values are None if not in the catalog.
+    """
+    info = {'seed': None, 'vistime': None, 'filter': None, 'magnitude': None}
+    keys = {'SIM_SEED': 'seed', 'SIM_VISTIME': 'vistime', 'Opsim_filter': 'filter'}
+    with open(catalog, 'r') as f:
+        for line in f:
+            row = line.split()
+            if len(row) < 2:
+                continue
+            if row[0] in keys:
+                info[keys[row[0]]] = float(row[1])
+            elif row[0] == 'object' and info['magnitude'] is None:
+                info['magnitude'] = float(row[4])
+    for key in ('seed', 'filter'):
+        if info[key] is not None:
+            info[key] = int(info[key])
+    return info
+
+
+def get_maxrss_bytes(rusage):
+    """Peak memory in bytes, ru_maxrss is bytes on mac and kilobytes on linux."""
+    if sys.platform == 'darwin':
+        return rusage.ru_maxrss
+    return rusage.ru_maxrss * 1024
+
+
+def get_folder_size(folder):
+    """Total bytes of the files in a folder and its subfolders."""
+    total = 0
+    for root, dirs, files in os.walk(folder):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                pass
+    return total
+
+
+def get_record(job, result):
+    """Get one ledger row from a job and the result of a4.run_job."""
+    record = {'date': time.strftime('%Y-%m-%d %H:%M:%S'), 'name': job['name']}
+    try:
+        record.update(get_catalog_info(job['catalog']))
+    except (OSError, ValueError, IndexError):
+        pass
+    record['returncode'] = result['returncode']
+    record['cached'] = int(result.get('cached', False))
+    record['wall_sec'] = round(result['seconds'], 3)
+    for key in ('user_sec', 'sys_sec', 'maxrss_bytes', 'out_bytes', 'write_blocks'):
+        record[key] = result.get(key)
+    for key in ('user_sec', 'sys_sec'):
+        if record[key] is not None:
+            record[key] = round(record[key], 3)
+    return record
+
+
+def append_record(record, ledger_file=ledger_file):
+    """Append one row to the ledger, writing the header for a new file.
+
+    The row is written with one call in append mode, so several processes
+    can share the ledger.
+    """
+    buf = io.StringIO()
+    writer = csv.DictWriter(buf, fieldnames=fields, extrasaction='ignore')
+    if not os.path.exists(ledger_file) or os.path.getsize(ledger_file) == 0:
+        writer.writeheader()
+    writer.writerow(record)
+    with open(ledger_file, 'a') as f:
+        f.write(buf.getvalue())
+
+
+def read_ledger(ledger_file=ledger_file):
+    """Read all rows of the ledger, numbers converted to float.
+
+    :Returns: list of dictionaries, empty if there is no ledger.
+    """
+    if not os.path.exists(ledger_file):
+        return []
+    records = []
+    with open(ledger_file, 'r') as f:
+        for row in csv.DictReader(f):
+            for key in fields[2:]:
+                try:
+                    row[key] = float(row[key])
+                except (TypeError, ValueError):
+                    row[key] = None
+            records.append(row)
+    return records
+
+
+def get_photons(info):
+    """Relative number of photons of a run, vistime * 10**(-0.4 magnitude)."""
+    if not info.get('vistime') or info.get('magnitude') is None:
+        return None
+    return info['vistime'] * 10**(-0.4 * info['magnitude'])
+
+
+def estimate_seconds(name, info, records, default=None):
+    """Estimate the wall time of a phosim run from past runs.
+
+    :Inputs: name of the catalog, info from get_catalog_info and records
+        from read_ledger.
+
+    :Returns: estimated seconds, or default if there are no past runs.
+    """
+    runs = [r for r in records
+            if r['returncode'] == 0 and not r['cached'] and r['wall_sec']]
+
+    exact = [r['wall_sec'] for r in runs
+             if r['name'] == name and r['magnitude'] == info.get('magnitude')
+             and r['vistime'] == info.get('vistime')
+             and r['filter'] == info.get('filter')]
+    if exact:
+        return statistics.median(exact)
+
+    photons = get_photons(info)
+    if photons is None:
+        return default
+    for same in (lambda r: r['name'] == name and r['filter'] == info.get('filter'),
+                 lambda r: r['filter'] == info.get('filter'),
+                 lambda r: True):
+        scaled = [r['wall_sec'] * photons / get_photons(r)
+                  for r in runs if same(r) and get_photons(r)]
+        if scaled:
+            return statistics.median(scaled)
+    return default
@@ -0,0 +1,465 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 08, 2017 Tue
+# Last update :
+"""Job queue of phosim runs on a shared folder, for many workers on many hosts.
+
+:Outputs:
+    queue/pending/name.json
+
+    queue/running/name@host.pid.json
+
+    queue/running/name@host.pid.pgid
+
+    queue/done/name.json
+
+    queue/failed/name.json
+
+:Info:
+
+  1. Every job of a4_run_phosim_all_catalogs (get_job) is one json file.
+     Nothing but a folder shared by all the hosts (e.g. nfs) is needed,
+     there is no scheduler service.
+
+  2. A worker claims a job by renaming pending/name.json to
+     running/name@worker.json. A rename is atomic, so only one worker gets
+     each job.
+
+  3. While phosim runs the worker touches its running file every
+     heartbeat seconds. A running file not touched for lease seconds
+     belongs to a dead worker, any worker puts its job back in pending.
+     The clocks of the hosts should be synchronized (ntp).
+
+  4. A worker that loses its lease stops its phosim process group. The
+     process group id of phosim is also kept in running/name@worker.pgid,
+     so when a worker was killed or crashed, recover_stale stops the
+     orphaned phosim before it requeues the job, if it runs on the same
+     host. After a hard crash of a worker on another host this is not
+     possible, and the requeued job may run while the orphan still writes
+     to the same outdir.
+
+  5. A finished job is written to done/ with the result of a4.run_job, a
+     failed job goes back to pending until it fails max_attempts times,
+     then it goes to failed/. submit skips jobs that are done, pending
+     or running, and failed jobs unless ``--retry-failed`` is given.
+
+  6. The outputs are written to the outdir of the job, so scripts_dir must
+     be the same path on all the hosts. phosim_dir and phosim_exe are the
+     local ones of each worker.
+
+:Usage:
+    python phosim_queue.py submit /shared/queue --scripts-dir /shared/scripts/
+
+    python phosim_queue.py worker /shared/queue -n 4    # on every host
+
+    python phosim_queue.py status /shared/queue
+
+"""
+
+# Imports
+import argparse
+import json
+import multiprocessing
+import os
+import signal
+import socket
+import threading
+import time
+import a4_run_phosim_all_catalogs as a4
+import phosim_ledger
+
+# Global Variables
+queue_dir = 'phosim_queue'
+states = ['pending', 'running', 'done', 'failed', 'tmp']
+
+
+def get_worker_id():
+    """Worker id from host name and process id, e.g. node3.12345"""
+    return '{}.{:d}'.format(socket.gethostname().split('.')[0], os.getpid())
+
+
+class JobQueue(object):
+    """Phosim job queue in a shared folder.
+
+    :Usage:
+      queue = JobQueue('/shared/queue')
+
+      queue.submit(a4.get_jobs())
+
+      claimed = queue.claim(get_worker_id())
+    """
+
+    def __init__(self, path=queue_dir, lease=300.0, max_attempts=3):
+        self.path = path
+        self.lease = lease
+        self.max_attempts = max_attempts
+        for state in states:
+            folder = os.path.join(path, state)
+            if not os.path.exists(folder):
+                os.makedirs(folder, exist_ok=True)
+
+    def get_file(self, state, name):
+        return os.path.join(self.path, state, name + '.json')
+
+    def list(self, state):
+        """Names of the files in one state folder, sorted."""
+        return sorted(name[:-5] for name in os.listdir(os.path.join(self.path, state))
+                      if name.endswith('.json'))
+
+    def write(self, outfile, entry):
+        """Write a json file atomically through the tmp folder."""
+        tmpfile = os.path.join(self.path, 'tmp', '{}.{}.json'.format(
+            os.path.basename(outfile)[:-5], get_worker_id()))
+        with open(tmpfile, 'w') as f:
+            json.dump(entry, f, indent=1, sort_keys=True)
+        os.replace(tmpfile, outfile)
+
+    def get_running(self, name):
+        """Running files of a job whose lease is not expired."""
+        now = time.time()
+        live = []
+        for running_name in self.list('running'):
+            if running_name.partition('@')[0] != name:
+                continue
+            try:
+                st = os.stat(os.path.join(self.path, 'running', running_name + '.json'))
+            except OSError:
+                continue
+            if now - max(st.st_mtime, st.st_ctime) < self.lease:
+                live.append(running_name)
+        return live
+
+    def submit(self, jobs, retry_failed=False):
+        """Put jobs in pending.
+
+        Jobs that are done, already pending or running on a live worker
+        are not submitted again, failed jobs only with retry_failed.
+        """
+        submitted = []
+        for job in jobs:
+            name = job['name']
+            if os.path.exists(self.get_file('done', name)) or \
+               os.path.exists(self.get_file('pending', name)) or \
+               self.get_running(name):
+                continue
+            failed = self.get_file('failed', name)
+            if os.path.exists(failed):
+                if not retry_failed:
+                    continue
+                os.remove(failed)
+            self.write(self.get_file('pending', name),
+                       {'job': job, 'attempts': 0, 'submitted': time.ctime()})
+            submitted.append(name)
+        return submitted
+
+    def claim(self, worker_id):
+        """Claim one pending job.
+
+        :Returns: (entry, running file), or None if nothing is pending.
+        """
+        for name in self.list('pending'):
+            running = os.path.join(self.path, 'running',
+                                   '{}@{}.json'.format(name, worker_id))
+            try:
+                os.rename(self.get_file('pending', name), running)
+            except OSError:
+                # another worker was faster
+                continue
+            # rename keeps the old mtime, start the lease now
+            os.utime(running)
+            with open(running, 'r') as f:
+                entry = json.load(f)
+            if os.path.exists(self.get_file('done', name)):
+                # requeued after its first worker had finished it
+                os.remove(running)
+                continue
+            return entry, running
+        return None
+
+    def get_pgid_file(self, running):
+        """File with the phosim process group id of a running file."""
+        return running[:-5] + '.pgid'
+
+    def write_pgid(self, running, pgid):
+        with open(self.get_pgid_file(running), 'w') as f:
+            f.write('{:d}\n'.format(pgid))
+
+    def stop_orphan(self, running, worker_id):
+        """Stop the phosim of a dead worker if it ran on this host.
+
+        :Returns: the process group id that was stopped, or None.
+        """
+        pgid_file = self.get_pgid_file(running)
+        try:
+            with open(pgid_file, 'r') as f:
+                pgid = int(f.read())
+        except (OSError, ValueError):
+            return None
+        finally:
+            try:
+                os.remove(pgid_file)
+            except OSError:
+                pass
+        if worker_id.rpartition('.')[0] != get_worker_id().rpartition('.')[0]:
+            return None
+        stop_process_group(pgid)
+        return pgid
+
+    def heartbeat(self, running):
+        """Renew the lease of a running job.
+
+        :Returns: False if the lease was lost (the job was requeued).
+        """
+        try:
+            os.utime(running)
+            return True
+        except OSError:
+            return False
+
+    def finish(self, entry, running, result):
+        """Record the result of a job, done or back to pending or failed."""
+        name = entry['job']['name']
+        entry = dict(entry, attempts=entry['attempts'] + 1, result=result,
+                     worker=os.path.basename(running)[:-5].partition('@')[2],
+                     finished=time.ctime())
+        if result['returncode'] == 0:
+            self.write(self.get_file('done', name), entry)
+        elif entry['attempts'] >= self.max_attempts:
+            self.write(self.get_file('failed', name), entry)
+        else:
+            self.write(self.get_file('pending', name), entry)
+        for path in (running, self.get_pgid_file(running)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def recover_stale(self):
+        """Put the jobs of workers without heartbeat back in pending.
+
+        :Returns: list of requeued job names.
+        """
+        requeued = []
+        now = time.time()
+        for running_name in self.list('running'):
+            running = os.path.join(self.path, 'running', running_name + '.json')
+            try:
+                st = os.stat(running)
+            except OSError:
+                continue
+            if now - max(st.st_mtime, st.st_ctime) < self.lease:
+                continue
+
+            # only one worker wins the rename and requeues the job
+            stale = os.path.join(self.path, 'tmp', running_name + '.stale.json')
+            try:
+                os.rename(running, stale)
+            except OSError:
+                continue
+            with open(stale, 'r') as f:
+                entry = json.load(f)
+            name, _, worker_id = running_name.partition('@')
+            # an orphaned phosim must not write to outdir with the next worker
+            pgid = self.stop_orphan(running, worker_id)
+            if pgid is not None:
+                print('{} {} {}'.format('stopped orphan :', name,
+                                        'process group {:d}'.format(pgid)))
+            entry = dict(entry, attempts=entry['attempts'] + 1,
+                         result={'returncode': None, 'stale': worker_id})
+            state = 'failed' if entry['attempts'] >= self.max_attempts else 'pending'
+            self.write(self.get_file(state, name), entry)
+            os.remove(stale)
+            print('{} {} {}'.format('requeue stale :', name, 'of ' + worker_id))
+            requeued.append(name)
+        return requeued
+
+    def status(self):
+        """Count jobs in each state."""
+        return {state: len(self.list(state)) for state in states[:4]}
+
+
+def stop_process_group(pid, grace=10.0):
+    """Stop the process group of pid, SIGTERM first, then SIGKILL.
+
+    The process itself is reaped by whoever started it.
+    """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(pid, sig)
+        except ProcessLookupError:
+            return
+        end = time.time() + grace
+        while time.time() < end:
+            time.sleep(0.1)
+            try:
+                os.killpg(pid, 0)
+            except ProcessLookupError:
+                return
+
+
+class Heartbeat(threading.Thread):
+    """Touch a running file every interval seconds until stopped.
+
+    The lease is lost when the running file was requeued by another
+    worker, or when it could not be touched for lease - interval seconds,
+    i.e. before another worker can requeue it. Then the phosim process
+    group (proc, set with on_start) is stopped.
+    """
+
+    def __init__(self, queue, running, interval):
+        threading.Thread.__init__(self, daemon=True)
+        self.queue = queue
+        self.running = running
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.lost = threading.Event()
+        self.lock = threading.Lock()
+        self.proc = None
+
+    def on_start(self, proc):
+        """Keep the phosim process, stop it at once if the lease is lost.
+
+        Its process group id is written next to the running file for
+        recover_stale.
+        """
+        with self.lock:
+            self.proc = proc
+            lost = self.lost.is_set()
+        if not lost:
+            self.queue.write_pgid(self.running, proc.pid)
+        if lost:
+            stop_process_group(proc.pid)
+
+    def run(self):
+        last = time.time()
+        while not self.stopped.wait(self.interval):
+            if self.queue.heartbeat(self.running):
+                last = time.time()
+            elif not os.path.exists(self.running) or \
+                 time.time() - last > self.queue.lease - self.interval:
+                with self.lock:
+                    self.lost.set()
+                    proc = self.proc
+                if proc is not None:
+                    stop_process_group(proc.pid)
+                return
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+def run_worker(path, phosim_dir=a4.phosim_dir, phosim_exe=a4.phosim_exe,
+               cache_dir=None, ledger_file=None, lease=300.0, heartbeat=30.0,
+               poll=10.0, max_attempts=3, exit_when_empty=True):
+    """Run queued jobs one after another until the queue is empty.
+
+    With exit_when_empty=False the worker waits for new jobs forever.
+    """
+    queue = JobQueue(path, lease, max_attempts)
+    worker_id = get_worker_id()
+    njobs = 0
+    while True:
+        queue.recover_stale()
+        claimed = queue.claim(worker_id)
+        if claimed is None:
+            if exit_when_empty and not queue.list('pending') and not queue.list('running'):
+                break
+            time.sleep(poll)
+            continue
+
+        entry, running = claimed
+        job = entry['job']
+        print('{} {} {}'.format('worker ' + worker_id, 'claimed', job['name']))
+        beat = Heartbeat(queue, running, heartbeat)
+        beat.start()
+        try:
+            a4.replace_outdir(job['outdir'])
+            result = a4.run_job(job, phosim_dir, phosim_exe, cache_dir,
+                                on_start=beat.on_start)
+        except Exception as e:
+            result = {'name': job['name'], 'returncode': -1, 'seconds': 0.0,
+                      'error': repr(e)}
+        finally:
+            beat.stop()
+
+        if beat.lost.is_set():
+            print('{} {} {}'.format('worker ' + worker_id, 'lost the lease of', job['name']))
+            try:
+                os.remove(queue.get_pgid_file(running))
+            except OSError:
+                pass
+            continue
+        queue.finish(entry, running, result)
+        if ledger_file:
+            phosim_ledger.append_record(phosim_ledger.get_record(job, result),
+                                        ledger_file)
+        njobs += 1
+    print('{} {} {}'.format('worker ' + worker_id, 'finished, jobs run:', njobs))
+    return njobs
+
+
+def run_workers(nworkers, path, **kwargs):
+    """Run nworkers worker processes on this host and wait for them."""
+    procs = [multiprocessing.Process(target=run_worker, args=(path,), kwargs=kwargs)
+             for i in range(nworkers)]
+    for proc in procs:
+        proc.start()
+    for proc in procs:
+        proc.join()
+    return [proc.exitcode for proc in procs]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Phosim job queue on a shared folder.')
+    parser.add_argument('command', choices=['submit', 'worker', 'status'])
+    parser.add_argument('queue', nargs='?', default=queue_dir)
+    parser.add_argument('--scripts-dir', default=a4.scripts_dir,
+                        help='shared folder of the catalogs and outputs (submit)')
+    parser.add_argument('--nbands', type=int, default=21)
+    parser.add_argument('--names', nargs='*', default=None,
+                        help='catalog names to submit instead of all bands')
+    parser.add_argument('-n', '--nworkers', type=int, default=1,
+                        help='worker processes on this host')
+    parser.add_argument('--phosim-dir', default=a4.phosim_dir)
+    parser.add_argument('--phosim-exe', default=a4.phosim_exe)
+    parser.add_argument('--cache-dir', default=None)
+    parser.add_argument('--ledger', default=None)
+    parser.add_argument('--lease', type=float, default=300.0,
+                        help='seconds without heartbeat before a job is requeued')
+    parser.add_argument('--heartbeat', type=float, default=30.0)
+    parser.add_argument('--poll', type=float, default=10.0)
+    parser.add_argument('--max-attempts', type=int, default=3)
+    parser.add_argument('--forever', action='store_true',
+                        help='keep waiting for new jobs')
+    parser.add_argument('--retry-failed', action='store_true',
+                        help='submit failed jobs again (submit)')
+    args = parser.parse_args()
+
+    if args.command == 'submit':
+        if args.names:
+            jobs = [a4.get_job(name, args.scripts_dir) for name in args.names]
+        else:
+            jobs = a4.get_jobs(args.nbands, args.scripts_dir)
+        queue = JobQueue(args.queue, args.lease, args.max_attempts)
+        submitted = queue.submit(jobs, args.retry_failed)
+        print('{} {} {}'.format('submitted', len(submitted), 'jobs to ' + args.queue))
+    elif args.command == 'worker':
+        kwargs = dict(phosim_dir=args.phosim_dir, phosim_exe=args.phosim_exe,
+                      cache_dir=args.cache_dir, ledger_file=args.ledger,
+                      lease=args.lease, heartbeat=args.heartbeat,
+                      poll=args.poll, max_attempts=args.max_attempts,
+                      exit_when_empty=not args.forever)
+        if args.nworkers == 1:
+            run_worker(args.queue, **kwargs)
+        else:
+            run_workers(args.nworkers, args.queue, **kwargs)
+
+    queue = JobQueue(args.queue, args.lease, args.max_attempts)
+    print('{} {} {}'.format('queue', args.queue, queue.status()))
+
+
+if __name__ == '__main__':
+    main()
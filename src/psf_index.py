@@ -0,0 +1,170 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 14, 2017 Mon
+# Last update :
+"""Index of psf statistics kept next to the psf files, e.g. by a6 and read by a7.
+
+:Outputs:
+    folder/psf_index.json
+
+:Info:
+
+  1. For every psf fitsfile of a folder the index has its sum, max, peak
+     pixel, centroid, second moments, shape and dtype, together with the
+     sha1, size and modification time of the file.
+
+  2. Stages that write psfs (a5_extract_psf_stamps, a6, a8) add the
+     statistics of the data they have in memory, so nothing is read again.
+
+  3. A reader (a7) gets the statistics with lookup. A file whose size or
+     modification time changed is hashed again, and its statistics are
+     computed again only if its sha1 changed. Files not in the index are
+     added on the first lookup.
+
+  4. Positions are 0-based (x, y) pixels, moments are (xx, yy, xy) in
+     pixels squared.
+
+:Usage:
+    index = PsfIndex('phosim_normalized_psf')
+
+    stats = index.lookup('phosim_normalized_psf/psf10.fits')
+
+    index.save()
+
+"""
+
+# Imports
+import json
+import os
+import threading
+import time
+from astropy.io import fits
+import numpy as np
+from phosim_cache import hash_file
+
+# Global Variables
+index_name = 'psf_index.json'
+chunk_rows = 512  # rows of an image converted to float64 at once
+
+
+def can_memmap(infile):
+    """False if the image has BZERO, BSCALE or BLANK.
+
+    astropy cannot memory map a scaled image, e.g. unsigned 16 bit with
+    BZERO = 32768, such a file is read whole and scaled to float.
+    """
+    header = fits.getheader(infile)
+    return not any(key in header for key in ('BZERO', 'BSCALE', 'BLANK'))
+
+
+def get_moments(data, chunk_rows=chunk_rows):
+    """Get sum, centroid (x, y) and second moments (xx, yy, xy).
+
+    The image is read in blocks of rows in float64, so a memory mapped
+    full chip is never copied whole.
+    """
+    ny, nx = data.shape
+    x = np.arange(nx, dtype='float64')
+    y = np.arange(ny, dtype='float64')
+    colsum = np.zeros(nx, dtype='float64')
+    rowsum = np.zeros(ny, dtype='float64')
+    for r0 in range(0, ny, chunk_rows):
+        block = np.asarray(data[r0:r0 + chunk_rows], dtype='float64')
+        colsum += block.sum(axis=0)
+        rowsum[r0:r0 + len(block)] = block.sum(axis=1)
+
+    total = rowsum.sum()
+    xc = colsum.dot(x) / total
+    yc = rowsum.dot(y) / total
+    dx, dy = x - xc, y - yc
+    xx = colsum.dot(dx * dx) / total
+    yy = rowsum.dot(dy * dy) / total
+    xy = 0.0
+    for r0 in range(0, ny, chunk_rows):
+        block = np.asarray(data[r0:r0 + chunk_rows], dtype='float64')
+        xy += block.dot(dx).dot(dy[r0:r0 + len(block)])
+    return total, (xc, yc), (xx, yy, xy / total)
+
+
+def get_stats(data):
+    """Statistics of one psf image as a json friendly dictionary."""
+    total, (xc, yc), (xx, yy, xy) = get_moments(data)
+    peak = int(np.argmax(data))
+    py, px = np.unravel_index(peak, data.shape)
+    return {'sum'     : float(total),
+            'max'     : float(data[py, px]),
+            'peak'    : [int(px), int(py)],
+            'centroid': [float(xc), float(yc)],
+            'moments' : [float(xx), float(yy), float(xy)],
+            'shape'   : list(data.shape),
+            'dtype'   : data.dtype.str}
+
+
+class PsfIndex(object):
+    """Statistics of the psf files of one folder, kept in folder/psf_index.json.
+
+    add and lookup can be called from many threads, save writes the index
+    atomically.
+    """
+
+    def __init__(self, folder):
+        self.folder = folder
+        self.path = os.path.join(folder, index_name)
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.changed = False
+        if os.path.exists(self.path):
+            with open(self.path, 'r') as f:
+                self.entries = json.load(f)['files']
+
+    def add(self, infile, data=None):
+        """Add the statistics of a psf file just written.
+
+        data is the image written to infile, if it is None the file is read.
+        """
+        if data is None:
+            with fits.open(infile, memmap=can_memmap(infile)) as hdul:
+                entry = get_stats(hdul[0].data)
+        else:
+            entry = get_stats(data)
+        st = os.stat(infile)
+        entry.update(sha1=hash_file(infile).hexdigest(), size=st.st_size,
+                     mtime_ns=st.st_mtime_ns)
+        with self.lock:
+            self.entries[os.path.basename(infile)] = entry
+            self.changed = True
+        return entry
+
+    def lookup(self, infile):
+        """Get the statistics of a psf file, computing them only if needed."""
+        name = os.path.basename(infile)
+        with self.lock:
+            entry = self.entries.get(name)
+        if entry is None:
+            return self.add(infile)
+
+        st = os.stat(infile)
+        if entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+            return entry
+        if entry['size'] == st.st_size and hash_file(infile).hexdigest() == entry['sha1']:
+            # touched but not changed
+            with self.lock:
+                entry['mtime_ns'] = st.st_mtime_ns
+                self.changed = True
+            return entry
+        return self.add(infile)
+
+    def save(self):
+        """Write the index if anything was added or updated."""
+        with self.lock:
+            if not self.changed:
+                return self.path
+            tmpfile = '{}.{:d}.tmp'.format(self.path, os.getpid())
+            with open(tmpfile, 'w') as f:
+                json.dump({'updated': time.ctime(), 'files': self.entries}, f,
+                          indent=1, sort_keys=True)
+            os.replace(tmpfile, self.path)
+            self.changed = False
+        return self.path
@@ -0,0 +1,347 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Aug 09, 2017 Wed
+# Last update :
+"""This program runs the a0 to c1 scripts, rebuilding only stale outputs.
+
+:Outputs:
+    pipeline_state.json
+
+:Info:
+
+  1. Every stage (script) declares its input and output files as glob
+     patterns and the stages it depends on, see the list stages below.
+
+  2. A stage is run again only if the sha1 of its inputs, its script or its
+     command changed since its last successful run, or if its outputs
+     are missing or were changed. Otherwise it is skipped.
+
+  3. Since the hashes are of the file contents, a stage that is run again
+     but writes the same outputs does not make its later stages run, e.g.
+     changing original_seds/ssp_pf.cat runs a0 again but not a2.
+
+  4. Stages whose dependencies are finished run at the same time, e.g. a0
+     and a1, or a7 and a8, up to ``--jobs`` stages at once.
+
+  5. a4 uses the phosim cache (phosim_cache.py), so when one sed changes
+     phosim is run again only for the bands whose catalog or sed changed.
+
+  6. Hashes of files are kept in the state file with their size and
+     modification time, an unchanged file is not read again.
+
+:Usage:
+    python run_pipeline.py --scripts-dir /path/to/scripts/ -j 4
+
+    python run_pipeline.py --dry-run          # print what would run
+
+    python run_pipeline.py --force a5 a6      # run these even if up to date
+
+"""
+
+# Imports
+import argparse
+import concurrent.futures
+import glob
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import time
+from phosim_cache import hash_file
+import a2_create_narrowband_seds as a2
+
+# Global Variables
+src_dir = os.path.dirname(os.path.abspath(__file__))
+state_file = 'pipeline_state.json'
+# a pattern is a glob, or (glob, regex) to keep only the paths matching
+# regex, e.g. narrowband10.icat but not narrowband10_sub0.icat of
+# a4_run_phosim_subexposures.py
+band_catalogs = [('instance_catalogs/narrowband[0-9]*.icat', r'/narrowband\d+\.icat$'),
+                 'instance_catalogs/broadband.icat']
+band_outputs = ('phosim_output_zipped/*_out/*.fits.gz',
+                r'^phosim_output_zipped/(narrowband\d+|broadband)_out/')
+stages = [
+    {'name': 'a0', 'script': 'a0_interpolate_flux.py', 'deps': [],
+     'inputs': ['original_seds/ssp_pf.cat', 'original_seds/exp9_pf.cat'],
+     'outputs': ['original_seds/*_interpolated.cat']},
+    {'name': 'a1', 'script': 'a1_create_background.py', 'deps': [],
+     'inputs': [],
+     'outputs': ['backgrounds/background1.bkg']},
+    {'name': 'a2', 'script': 'a2_create_narrowband_seds.py', 'deps': ['a0'],
+     'inputs': [a2.infile],
+     'outputs': [a2.outfolder + '/*.sed']},
+    {'name': 'a3', 'script': 'a3_create_instance_catalogs_seed.py', 'deps': ['a2'],
+     'inputs': [a2.outfolder + '/*.sed'],
+     'outputs': band_catalogs},
+    {'name': 'a4', 'script': 'a4_run_phosim_all_catalogs.py', 'deps': ['a1', 'a3'],
+     'args': ['--scripts-dir', '{scripts_dir}', '--phosim-dir', '{phosim_dir}',
+              '--phosim-exe', '{phosim_exe}'],
+     'inputs': band_catalogs + [a2.outfolder + '/*.sed',
+                                'backgrounds/background1.bkg'],
+     'outputs': [band_outputs]},
+    {'name': 'a5', 'script': 'a5_unzip_all_psf.py', 'deps': ['a4'],
+     'inputs': [('phosim_output_zipped/*_out/lsst_e_*.fits.gz', band_outputs[1])],
+     'outputs': ['phosim_output_unzipped/*.fits']},
+    {'name': 'a6', 'script': 'a6_normalize_phosim_psf.py', 'deps': ['a5'],
+     'inputs': ['phosim_output_unzipped/psf*.fits'],
+     'outputs': ['phosim_normalized_psf/psf*.fits']},
+    {'name': 'a7', 'script': 'a7_psf_sum_all_pixels.py', 'deps': ['a6'],
+     'inputs': ['phosim_output_unzipped/*.fits', 'phosim_normalized_psf/*.fits'],
+     'outputs': []},
+    {'name': 'a8', 'script': 'a8_weighted_normalized_psf.py', 'deps': ['a6'],
+     'inputs': ['phosim_normalized_psf/psf*.fits'],
+     'outputs': ['weighted_psf.fits']},
+    {'name': 'b1', 'script': 'b1_sum_narrowbands.py', 'deps': ['a4'],
+     'inputs': [('phosim_output_zipped/narrowband*_out/lsst_e_*.fits.gz',
+                 r'^phosim_output_zipped/narrowband\d+_out/')],
+     'outputs': ['phosim_output_zipped/narrowbands_sum.fits']},
+    {'name': 'b2', 'script': 'b2_create_difference_fits.py', 'deps': ['b1'],
+     'inputs': ['phosim_output_zipped/narrowbands_sum.fits',
+                'phosim_output_zipped/broadband_out/lsst_e_*.fits.gz'],
+     'outputs': ['phosim_output_zipped/difference.fits']},
+    {'name': 'c1', 'script': 'c1_plot_sed.py', 'deps': [],
+     'inputs': ['original_seds/exp9_pf.cat'],
+     'outputs': ['original_seds/exp9_pf_6gyr.png']},
+]
+
+
+def get_files(patterns, scripts_dir):
+    """Files matching glob patterns, relative to scripts_dir and sorted.
+
+    A pattern (glob, regex) keeps only the relative paths matching regex.
+    """
+    files = set()
+    for pattern in patterns:
+        regex = None
+        if isinstance(pattern, tuple):
+            pattern, regex = pattern
+        for path in glob.glob(os.path.join(scripts_dir, pattern)):
+            name = os.path.relpath(path, scripts_dir)
+            if os.path.isfile(path) and (regex is None or re.search(regex, name)):
+                files.add(name)
+    return sorted(files)
+
+
+class Hasher(object):
+    """sha1 of files, reused while their size and mtime do not change."""
+
+    def __init__(self, known=None):
+        self.known = known or {}
+
+    def file_hash(self, path):
+        st = os.stat(path)
+        entry = self.known.get(path)
+        if entry and entry[0] == st.st_size and entry[1] == st.st_mtime_ns:
+            return entry[2]
+        sha1 = hash_file(path).hexdigest()
+        self.known[path] = [st.st_size, st.st_mtime_ns, sha1]
+        return sha1
+
+    def files_hash(self, files, scripts_dir, extra=()):
+        """One sha1 of many files (names and contents) and extra strings."""
+        sha = hashlib.sha1()
+        for text in extra:
+            sha.update(text.encode())
+        for name in files:
+            sha.update(name.encode())
+            sha.update(self.file_hash(os.path.join(scripts_dir, name)).encode())
+        return sha.hexdigest()
+
+
+def get_command(stage, options):
+    """Command of a stage, script from src_dir run with this python."""
+    args = [arg.format(**options) for arg in stage.get('args', [])]
+    return [sys.executable, os.path.join(src_dir, stage['script'])] + args
+
+
+def get_input_hash(stage, options, hasher):
+    scripts_dir = options['scripts_dir']
+    files = get_files(stage['inputs'], scripts_dir)
+    command = get_command(stage, options)
+    return hasher.files_hash(files, scripts_dir,
+                             extra=[' '.join(command[1:]),
+                                    hasher.file_hash(command[1])])
+
+
+def get_output_hash(stage, options, hasher):
+    """sha1 of the outputs, None if a declared output has no file."""
+    scripts_dir = options['scripts_dir']
+    for pattern in stage['outputs']:
+        if not get_files([pattern], scripts_dir):
+            return None
+    files = get_files(stage['outputs'], scripts_dir)
+    return hasher.files_hash(files, scripts_dir)
+
+
+def is_stale(stage, record, input_hash, output_hash):
+    """Why a stage must run, or None if it is up to date."""
+    if not record:
+        return 'never run'
+    if record['inputs'] != input_hash:
+        return 'inputs changed'
+    if stage['outputs'] and output_hash is None:
+        return 'outputs missing'
+    if record['outputs'] != output_hash:
+        return 'outputs changed'
+    return None
+
+
+def run_stage(stage, options):
+    """Run one stage with its log in scripts_dir/logs/name.log.
+
+    :Returns: exit code and seconds.
+    """
+    logdir = os.path.join(options['scripts_dir'], 'logs')
+    if not os.path.exists(logdir):
+        os.makedirs(logdir, exist_ok=True)
+    env = dict(os.environ, MPLBACKEND='Agg')
+    begin_time = time.time()
+    with open(os.path.join(logdir, stage['name'] + '.log'), 'w') as log:
+        returncode = subprocess.call(get_command(stage, options),
+                                     cwd=options['scripts_dir'], env=env,
+                                     stdout=log, stderr=subprocess.STDOUT)
+    return returncode, time.time() - begin_time
+
+
+def get_ancestors(names, by_name):
+    """Stages in names and all the stages they depend on."""
+    todo, found = list(names), set()
+    while todo:
+        name = todo.pop()
+        if name not in found:
+            found.add(name)
+            todo.extend(by_name[name]['deps'])
+    return found
+
+
+def run_pipeline(scripts_dir, targets=None, force=(), jobs=2, dry_run=False,
+                 phosim_dir='~/phosim', phosim_exe='./phosim',
+                 stages=stages):
+    """Run the stale stages of the pipeline, independent stages concurrently.
+
+    :Returns: dictionary of stage name to ran, skipped or failed.
+    """
+    scripts_dir = os.path.abspath(scripts_dir)
+    options = {'scripts_dir': scripts_dir + os.sep,
+               'phosim_dir': os.path.expanduser(phosim_dir),
+               'phosim_exe': phosim_exe}
+    by_name = {stage['name']: stage for stage in stages}
+    wanted = get_ancestors(targets or list(by_name), by_name)
+
+    path = os.path.join(scripts_dir, state_file)
+    state = {'stages': {}, 'files': {}}
+    if os.path.exists(path):
+        with open(path, 'r') as f:
+            state = json.load(f)
+    hasher = Hasher({os.path.join(scripts_dir, name): entry
+                     for name, entry in state['files'].items()})
+
+    def save_state():
+        state['files'] = {os.path.relpath(p, scripts_dir): entry
+                          for p, entry in hasher.known.items()}
+        tmpfile = path + '.tmp'
+        with open(tmpfile, 'w') as f:
+            json.dump(state, f, indent=1, sort_keys=True)
+        os.replace(tmpfile, path)
+
+    status = {}
+    waiting = [name for name in by_name if name in wanted]
+    running = {}
+    with concurrent.futures.ThreadPoolExecutor(max_workers=jobs) as pool:
+        while waiting or running:
+            for name in list(waiting):
+                deps = by_name[name]['deps']
+                if any(dep in wanted and dep not in status for dep in deps):
+                    continue
+                waiting.remove(name)
+                stage = by_name[name]
+                if any(status.get(dep) == 'failed' for dep in deps):
+                    status[name] = 'failed'
+                    print('{} {} {}'.format('not run  :', name, 'a dependency failed'))
+                    continue
+
+                input_hash = get_input_hash(stage, options, hasher)
+                output_hash = get_output_hash(stage, options, hasher)
+                reason = is_stale(stage, state['stages'].get(name), input_hash,
+                                  output_hash)
+                if name in force:
+                    reason = 'forced'
+                if reason is None:
+                    status[name] = 'skipped'
+                    print('{} {} {}'.format('up to date:', name, ''))
+                    continue
+                if dry_run:
+                    # later stages are shown as they would be after this one
+                    status[name] = 'ran'
+                    print('{} {} {}'.format('would run:', name, reason))
+                    continue
+                print('{} {} {}'.format('running  :', name, reason))
+                running[pool.submit(run_stage, stage, options)] = (name, input_hash)
+
+            if not running:
+                continue
+            done, _ = concurrent.futures.wait(
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                name, input_hash = running.pop(future)
+                returncode, seconds = future.result()
+                if returncode != 0:
+                    status[name] = 'failed'
+                    state['stages'].pop(name, None)
+                    print('{} {} {}'.format('failed   :', name,
+                                            'exit code {:d}, see logs/{}.log'.format(returncode, name)))
+                else:
+                    status[name] = 'ran'
+                    state['stages'][name] = {
+                        'inputs': input_hash,
+                        'outputs': get_output_hash(by_name[name], options, hasher),
+                        'seconds': round(seconds, 3), 'updated': time.ctime()}
+                    print('{} {} {}'.format('finished :', name, '{:.1f} sec'.format(seconds)))
+                save_state()
+    return status
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Run the stale stages of the '
+                                                 'a0 to c1 pipeline.')
+    parser.add_argument('targets', nargs='*',
+                        help='stages to bring up to date, default all')
+    parser.add_argument('--scripts-dir', default='.')
+    parser.add_argument('-j', '--jobs', type=int, default=2,
+                        help='stages run at the same time')
+    parser.add_argument('--force', nargs='+', default=[],
+                        help='stages to run even if up to date')
+    parser.add_argument('--dry-run', action='store_true')
+    parser.add_argument('--phosim-dir', default='~/phosim')
+    parser.add_argument('--phosim-exe', default='./phosim')
+    args = parser.parse_args()
+
+    status = run_pipeline(args.scripts_dir, args.targets, args.force,
+                          args.jobs, args.dry_run, args.phosim_dir,
+                          args.phosim_exe)
+    return status
+
+
+if __name__ == '__main__':
+
+    # beginning time
+    begin_time,begin_ctime = time.time(), time.ctime()
+
+    # run main program
+    status = main()
+
+    # print the time taken
+    end_time,end_ctime  = time.time(), time.ctime()
+    seconds             = end_time - begin_time
+    m, s                = divmod(seconds, 60)
+    h, m                = divmod(m, 60)
+    d, h                = divmod(h, 24)
+    print('\nBegin time: ', begin_ctime,'\nEnd   time: ', end_ctime,'\n' )
+    print("Time taken: {0:.0f} days, {1:.0f} hours, \
+          {2:.0f} minutes, {3:f} seconds.".format(d, h, m, s))
+
+    sys.exit(1 if 'failed' in status.values() else 0)
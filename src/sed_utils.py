@@ -0,0 +1,328 @@
+#!python
+# -*- coding: utf-8 -*-
+#
+# Author      : Bhishan Poudel; Physics PhD Student, Ohio University
+# Date        : Jul 26, 2017 Wed
+# Last update :
+"""Shared utilities to read sed files used by the a0, a2 and c1 scripts.
+
+:Usage:
+    header, table = load_sed('original_seds/exp9_pf.cat')
+
+    sed = SED.from_file('original_seds/exp9_pf_6gyr_interpolated.cat')
+
+:Info:
+
+  1. A sed file (.cat, .sed or .txt) is parsed only once. The header lines
+     and the numeric table are stored in two sidecar files next to it:
+
+     original_seds/exp9_pf.cat.cache.npy  : float64 table, memory mappable
+
+     original_seds/exp9_pf.cat.cache.json : header lines and cache key
+
+     A sed read with skiprows has its own sidecars, e.g.
+     original_seds/exp9_pf.cat.s15.cache.npy for skiprows=15.
+
+  2. The cache key is the file size, mtime and sha1 of the content. When
+     size and mtime match the sidecar is used without reading the sed. When
+     only the mtime changed the content hash decides.
+
+  3. If the sidecar can not be written (e.g. read only folder) the parsed
+     data is returned anyway. A sidecar that can not be read or whose
+     table shape does not match its json is parsed again.
+
+  4. The SED class holds one wavelength and flux column in memory, so the
+     scripts can hand seds to each other without writing text files.
+
+"""
+
+# Imports
+import gzip
+import hashlib
+import json
+import os
+import numpy as np
+
+cache_version = 1
+
+
+def get_cache_files(infile, skiprows=None):
+    """Get sidecar file names for a sed file read with skiprows.
+
+    e.g. exp9_pf.cat.cache.npy for skiprows None, exp9_pf.cat.s15.cache.npy
+    for skiprows 15, so a0 and c1 do not overwrite each other's cache.
+    """
+    prefix = infile if skiprows is None else '{}.s{:d}'.format(infile, skiprows)
+    return prefix + '.cache.npy', prefix + '.cache.json'
+
+
+def get_file_hash(infile, chunk_size=1 << 20):
+    """Get sha1 of the file content, read in chunks."""
+    sha = hashlib.sha1()
+    with open(infile, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def open_sed(infile, mode='r'):
+    """Open a sed file, gzip compressed if the name ends with .gz"""
+    if infile.endswith('.gz'):
+        return gzip.open(infile, mode + 't')
+    return open(infile, mode)
+
+
+def format_sed(wave, flux, fmt=('%-13.1f', '%.13e'), delimiter='\t'):
+    """Format two columns as sed text in one step.
+
+    The line format is repeated for every row and filled from one flat
+    tuple, which is much faster than np.savetxt or a loop over rows and
+    gives exactly the same text.
+    """
+    nrows = len(wave)
+    table = np.empty(2 * nrows, dtype='float64')
+    table[0::2] = wave
+    table[1::2] = flux
+    line = delimiter.join(fmt) + '\n'
+    return (line * nrows) % tuple(table.tolist())
+
+
+def write_text(outfile, text, compress=None):
+    """Write text with one call, gzip compressed if compress is True.
+
+    If compress is None the file is compressed when outfile ends with .gz
+    Phosim reads gzip compressed sed files directly.
+    """
+    if compress is None:
+        compress = outfile.endswith('.gz')
+    if compress:
+        with gzip.open(outfile, 'wt', compresslevel=6) as f:
+            f.write(text)
+    else:
+        with open(outfile, 'w', buffering=1 << 20) as f:
+            f.write(text)
+    return outfile
+
+
+def write_sed(outfile, wave, flux, header=None, fmt=('%-13.1f', '%.13e'),
+              compress=None):
+    """Write a two column sed file.
+
+    :Usage: write_sed('original_seds/test.cat', wave, flux)
+
+    The default format is the same as a0, e.g. '5000.0       \t5.2978750000000e-05'
+    """
+    header = ''.join(header) if header else ''
+    return write_text(outfile, header + format_sed(wave, flux, fmt), compress)
+
+
+def parse_sed(infile, skiprows=None):
+    """Parse a sed text file.
+
+    :Returns:
+        header : list of header lines.
+
+        table  : 2d float64 array, column 0 is wavelength.
+
+    If skiprows is None the header is the leading comment (#) and blank
+    lines, otherwise it is the first skiprows lines.
+    """
+    with open_sed(infile, 'r') as f:
+        lines = f.readlines()
+
+    if skiprows is None:
+        skiprows = 0
+        for line in lines:
+            if line.strip().startswith('#') or not line.strip():
+                skiprows += 1
+            else:
+                break
+
+    header = lines[:skiprows]
+    table = np.loadtxt(lines[skiprows:], dtype='float', comments='#', ndmin=2)
+    return header, table
+
+
+def read_cache(infile, skiprows, stat):
+    """Return (header, table) from sidecar files, or None if stale."""
+    npyfile, jsonfile = get_cache_files(infile, skiprows)
+    if not (os.path.exists(npyfile) and os.path.exists(jsonfile)):
+        return None
+
+    try:
+        with open(jsonfile, 'r') as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+
+    if meta.get('version') != cache_version or \
+       meta.get('skiprows') != skiprows or \
+       meta.get('size') != stat.st_size:
+        return None
+
+    # mtime changed, check the content before using the cache
+    if meta.get('mtime_ns') != stat.st_mtime_ns:
+        if meta.get('sha1') != get_file_hash(infile):
+            return None
+        meta['mtime_ns'] = stat.st_mtime_ns
+        write_json(jsonfile, meta)
+
+    # a sidecar written by another process in between is a cache miss
+    try:
+        table = np.load(npyfile, mmap_mode='r')
+    except (OSError, ValueError):
+        return None
+    if table.shape != tuple(meta.get('shape', ())):
+        return None
+    return meta['header'], table
+
+
+def write_json(jsonfile, meta):
+    """Write json atomically."""
+    tmpfile = '{}.{:d}.tmp'.format(jsonfile, os.getpid())
+    with open(tmpfile, 'w') as f:
+        json.dump(meta, f)
+    os.replace(tmpfile, jsonfile)
+
+
+def write_cache(infile, skiprows, stat, header, table):
+    """Write sidecar files for a parsed sed."""
+    npyfile, jsonfile = get_cache_files(infile, skiprows)
+    meta = {'version': cache_version,
+            'skiprows': skiprows,
+            'size': stat.st_size,
+            'mtime_ns': stat.st_mtime_ns,
+            'sha1': get_file_hash(infile),
+            'header': header,
+            'shape': list(table.shape)}
+
+    # write npy first, json last, so json only exists for a complete npy
+    tmpfile = '{}.{:d}.tmp'.format(npyfile, os.getpid())
+    with open(tmpfile, 'wb') as f:
+        np.save(f, np.ascontiguousarray(table, dtype='float64'))
+    os.replace(tmpfile, npyfile)
+    write_json(jsonfile, meta)
+
+
+def load_sed(infile, skiprows=None, cache=True):
+    """Load a sed file, using the sidecar cache when it is valid.
+
+    :Usage: header, table = load_sed('original_seds/exp9_pf.cat')
+
+    :Returns:
+        header : list of header lines.
+
+        table  : 2d float64 array (read only memmap when loaded from
+                 the cache), column 0 is wavelength.
+    """
+    stat = os.stat(infile)
+    if cache:
+        cached = read_cache(infile, skiprows, stat)
+        if cached is not None:
+            return cached
+
+    header, table = parse_sed(infile, skiprows)
+    if cache:
+        try:
+            write_cache(infile, skiprows, stat, header, table)
+        except OSError as e:
+            print('Could not write sed cache for %s: %s' % (infile, e))
+
+    return header, table
+
+
+class SED(object):
+    """Sed with float64 wavelength and flux arrays and the header lines.
+
+    :Usage:
+      sed = SED.from_file('original_seds/exp9_pf_6gyr_interpolated.cat')
+
+      band = sed.band(5310, 5388)
+
+      sed.write('narrowband_seds/test.sed')
+
+    The sed can be passed between a0, a2 and c1 in memory, the text file
+    is only written when phosim needs it.
+    """
+    __slots__ = ('wave', 'flux', 'header', 'name')
+
+    fmt = ('%-13.1f', '%.13e')
+
+    def __init__(self, wave, flux, header=None, name=''):
+        self.wave = np.ascontiguousarray(wave, dtype='float64')
+        self.flux = np.ascontiguousarray(flux, dtype='float64')
+        self.header = list(header) if header else []
+        self.name = name
+        if self.wave.shape != self.flux.shape or self.wave.ndim != 1:
+            raise ValueError('wave and flux must be 1d arrays of same length')
+
+    @classmethod
+    def from_file(cls, infile, col=1, skiprows=None):
+        """Read a sed file, column 0 is wavelength and col is flux."""
+        header, table = load_sed(infile, skiprows)
+        return cls(table[:, 0], table[:, col], header, infile)
+
+    def __len__(self):
+        return len(self.wave)
+
+    def __repr__(self):
+        return 'SED(%r, %d rows, %g-%g)' % (self.name, len(self),
+                                            self.wave[0], self.wave[-1])
+
+    def copy(self, flux=None):
+        """Copy of the sed, optionally with a new flux array."""
+        flux = self.flux.copy() if flux is None else flux
+        return SED(self.wave.copy(), flux, self.header, self.name)
+
+    def index(self, wave):
+        """Get exact row index of a wavelength by binary search."""
+        idx = int(np.searchsorted(self.wave, wave))
+        if idx == len(self.wave) or self.wave[idx] != wave:
+            raise ValueError('Wavelength %g not on the sed grid' % wave)
+        return idx
+
+    def flux_at(self, wave):
+        """Get flux at a wavelength on the grid."""
+        return self.flux[self.index(wave)]
+
+    def slice(self, lambda1, lambda2):
+        """Get the part of the sed with lambda1 <= wave <= lambda2."""
+        i = np.searchsorted(self.wave, lambda1, side='left')
+        j = np.searchsorted(self.wave, lambda2, side='right')
+        return SED(self.wave[i:j], self.flux[i:j], self.header, self.name)
+
+    def band_mask(self, lower, upper, inclusive=False):
+        """Boolean mask of lower <= wave < upper (<= upper if inclusive)."""
+        if inclusive:
+            return (self.wave >= lower) & (self.wave <= upper)
+        return (self.wave >= lower) & (self.wave < upper)
+
+    def band(self, lower, upper, inclusive=False):
+        """Get sed on the full grid with flux set to zero outside the band."""
+        mask = self.band_mask(lower, upper, inclusive)
+        return self.copy(np.where(mask, self.flux, 0.0))
+
+    def scale_at(self, wave, factor):
+        """Get sed with flux at one wavelength multiplied by factor.
+
+        e.g. scale_at(5000.0, 0.01) lowers the 500 nm phosim anchor.
+        """
+        out = self.copy()
+        out.flux[self.index(wave)] *= factor
+        return out
+
+    def renormalize(self, wave=5000.0, value=1.0):
+        """Get sed scaled so that flux at wave equals value."""
+        ref = self.flux_at(wave)
+        if ref == 0:
+            raise ValueError('Flux at %g is zero, can not renormalize' % wave)
+        return self.copy(self.flux * (value / ref))
+
+    def to_lines(self):
+        """Get the data lines in the a0 text format."""
+        return format_sed(self.wave, self.flux, self.fmt).splitlines(True)
+
+    def write(self, outfile, compress=None):
+        """Write the sed in the text format used by a0 and phosim."""
+        return write_sed(outfile, self.wave, self.flux, self.header, self.fmt,
+                         compress)